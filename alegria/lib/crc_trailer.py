@@ -0,0 +1,263 @@
+import amaranth as am
+import amaranth.lib.crc.catalog
+import amaranth.lib.stream
+import amaranth.lib.wiring
+
+from . import Framed
+
+__all__ = ['Checker', 'Appender']
+
+# frames that end in a crc of everything before it, with an optional one
+# word tag just before the crc. the crc goes out in the order that lets
+# the receiver check the whole frame at once: high word first, or low
+# word first for crcs with reflected output.
+#
+# both sides only do this while enable is set. it is looked at when each
+# frame ends, so it can change partway through one. the words that might
+# be the trailer are held back until then.
+
+def _crc_words(crc, data_width):
+    crc_width = crc.algorithm.crc_width
+    if crc.data_width != data_width:
+        raise ValueError('crc data_width must match data_width')
+    if crc_width % data_width != 0:
+        raise ValueError('crc width must be a multiple of data_width')
+    return crc_width // data_width
+
+# strips trailers off incoming frames and checks them. the frame word
+# after each frame has 1 in its data if the frame failed the check, and
+# tag has the tag of the frame that just ended
+class Checker(am.lib.wiring.Component):
+    def __init__(self, data_width=8, crc=None, tagged=False):
+        if crc is None:
+            crc = am.lib.crc.catalog.CRC16_XMODEM(data_width=data_width)
+
+        self.data_width = data_width
+        self.crc = crc
+        self.tagged = tagged
+        self._crc_words = _crc_words(crc, data_width)
+
+        ports = {
+            'i_data': am.lib.wiring.In(Framed(data_width)),
+            'i_valid': am.lib.wiring.In(1),
+            'i_ready': am.lib.wiring.Out(1),
+            'o_data': am.lib.wiring.Out(Framed(data_width)),
+            'o_valid': am.lib.wiring.Out(1),
+            'o_ready': am.lib.wiring.In(1),
+            'enable': am.lib.wiring.In(1),
+        }
+        if tagged:
+            ports['tag'] = am.lib.wiring.Out(data_width)
+
+        super().__init__(ports)
+
+    @property
+    def i_stream(self):
+        stream = am.lib.stream.Signature(self.i_data.shape()).flip().create()
+        stream.payload = self.i_data
+        stream.valid = self.i_valid
+        stream.ready = self.i_ready
+        return stream
+
+    @property
+    def o_stream(self):
+        stream = am.lib.stream.Signature(self.o_data.shape()).create()
+        stream.payload = self.o_data
+        stream.valid = self.o_valid
+        stream.ready = self.o_ready
+        return stream
+
+    def elaborate(self, platform):
+        m = am.Module()
+
+        width = self.data_width
+        # words held back, in case they turn out to be the trailer
+        depth = self._crc_words + self.tagged
+
+        m.submodules.crc = crc = self.crc.create()
+
+        # oldest word in the lowest bits
+        held = am.Signal(depth * width)
+        count = am.Signal(range(depth + 1))
+        # whether this frame has any words
+        seen = am.Signal()
+        # held words are going out as data, because this frame had no
+        # trailer after all
+        flushing = am.Signal()
+
+        m.d.comb += [
+            crc.data.eq(self.i_data.data),
+            self.o_data.data.eq(held[:width]),
+        ]
+        if self.tagged:
+            m.d.comb += self.tag.eq(held[:width])
+
+        with m.If(self.i_valid & ~self.i_data.frame):
+            with m.If(count != depth):
+                # room to hold on to it
+                m.d.comb += [
+                    self.i_ready.eq(1),
+                    crc.valid.eq(1),
+                ]
+                m.d.sync += [
+                    held.word_select(count, width).eq(self.i_data.data),
+                    count.eq(count + 1),
+                    seen.eq(1),
+                ]
+            with m.Else():
+                # send out the oldest held word to make room
+                m.d.comb += [
+                    self.o_valid.eq(1),
+                    self.i_ready.eq(self.o_ready),
+                ]
+                with m.If(self.o_ready):
+                    m.d.comb += crc.valid.eq(1)
+                    m.d.sync += held.eq(
+                        am.Cat(held[width:], self.i_data.data))
+
+        with m.Elif(self.i_valid):
+            with m.If((flushing | ~self.enable) & (count != 0)):
+                # no trailer, so the held words are data
+                m.d.comb += self.o_valid.eq(1)
+                with m.If(self.o_ready):
+                    m.d.sync += [
+                        held.eq(held >> width),
+                        count.eq(count - 1),
+                        flushing.eq(1),
+                    ]
+            with m.Else():
+                # drop the trailer, and pass on the frame word
+                m.d.comb += [
+                    self.o_data.frame.eq(1),
+                    self.o_data.data.eq(
+                        ~flushing & seen &
+                        ((count != depth) | ~crc.match_detected)),
+                    self.o_valid.eq(1),
+                    self.i_ready.eq(self.o_ready),
+                ]
+                with m.If(self.o_ready):
+                    m.d.comb += crc.start.eq(1)
+                    m.d.sync += [
+                        count.eq(0),
+                        seen.eq(0),
+                        flushing.eq(0),
+                    ]
+
+        return m
+
+# adds trailers to outgoing frames. a frame word with 1 in its data gets
+# a bad crc on purpose, so the other end knows something went wrong
+class Appender(am.lib.wiring.Component):
+    def __init__(self, data_width=8, crc=None, tagged=False):
+        if crc is None:
+            crc = am.lib.crc.catalog.CRC16_XMODEM(data_width=data_width)
+
+        self.data_width = data_width
+        self.crc = crc
+        self.tagged = tagged
+        self._crc_words = _crc_words(crc, data_width)
+
+        ports = {
+            'i_data': am.lib.wiring.In(Framed(data_width)),
+            'i_valid': am.lib.wiring.In(1),
+            'i_ready': am.lib.wiring.Out(1),
+            'o_data': am.lib.wiring.Out(Framed(data_width)),
+            'o_valid': am.lib.wiring.Out(1),
+            'o_ready': am.lib.wiring.In(1),
+            'enable': am.lib.wiring.In(1),
+        }
+        if tagged:
+            ports['tag'] = am.lib.wiring.In(data_width)
+
+        super().__init__(ports)
+
+    @property
+    def i_stream(self):
+        stream = am.lib.stream.Signature(self.i_data.shape()).flip().create()
+        stream.payload = self.i_data
+        stream.valid = self.i_valid
+        stream.ready = self.i_ready
+        return stream
+
+    @property
+    def o_stream(self):
+        stream = am.lib.stream.Signature(self.o_data.shape()).create()
+        stream.payload = self.o_data
+        stream.valid = self.o_valid
+        stream.ready = self.o_ready
+        return stream
+
+    def elaborate(self, platform):
+        m = am.Module()
+
+        width = self.data_width
+        words = self._crc_words
+
+        m.submodules.crc = crc = self.crc.create()
+
+        # whether this frame has any words
+        seen = am.Signal()
+        # how many trailer words have gone out
+        sent = am.Signal(range(words + self.tagged + 1))
+
+        # the crc, in the order it goes out
+        crc_out = crc.crc
+        if not self.crc.algorithm.reflect_output:
+            crc_out = am.Cat(*reversed(
+                [crc.crc.word_select(i, width) for i in range(words)]))
+
+        # everything passes through unless overwritten
+        m.d.comb += [
+            crc.data.eq(self.i_data.data),
+            self.o_data.eq(self.i_data),
+            self.o_valid.eq(self.i_valid),
+            self.i_ready.eq(self.o_ready),
+        ]
+
+        with m.If(self.i_valid & ~self.i_data.frame):
+            with m.If(self.o_ready):
+                m.d.comb += crc.valid.eq(1)
+                m.d.sync += seen.eq(1)
+
+        with m.Elif(self.i_valid & seen & self.enable &
+                    (sent != words + self.tagged)):
+            # end of a frame, send the trailer first
+            m.d.comb += [
+                self.o_data.frame.eq(0),
+                self.i_ready.eq(0),
+            ]
+
+            # the next crc word, which is wrong on purpose if the frame
+            # went wrong
+            index = am.Signal(range(words))
+            crc_word = am.Signal(width)
+            m.d.comb += [
+                index.eq(sent - self.tagged),
+                crc_word.eq(crc_out.word_select(index, width)),
+            ]
+            with m.If(self.i_data.data[0]):
+                m.d.comb += crc_word.eq(~crc_out.word_select(index, width))
+
+            m.d.comb += self.o_data.data.eq(crc_word)
+            if self.tagged:
+                with m.If(sent == 0):
+                    # the tag is covered by the crc too
+                    m.d.comb += [
+                        self.o_data.data.eq(self.tag),
+                        crc.data.eq(self.tag),
+                        crc.valid.eq(self.o_ready),
+                    ]
+
+            with m.If(self.o_ready):
+                m.d.sync += sent.eq(sent + 1)
+
+        with m.Elif(self.i_valid):
+            # frame word, start over after it
+            with m.If(self.o_ready):
+                m.d.comb += crc.start.eq(1)
+                m.d.sync += [
+                    seen.eq(0),
+                    sent.eq(0),
+                ]
+
+        return m
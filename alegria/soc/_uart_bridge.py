@@ -1,5 +1,6 @@
 import amaranth as am
 import amaranth.build
+import amaranth.lib.crc.catalog
 import amaranth.lib.enum
 import amaranth.lib.wiring
 import amaranth.utils
@@ -8,6 +9,7 @@ import amaranth_soc.wishbone
 
 from .. import lib
 from ..lib import cobs
+from ..lib import crc_trailer
 from ..lib import uart
 
 __all__ = ['UartBridge']
@@ -19,23 +21,116 @@ class UartBridge(am.lib.wiring.Component):
         COMMAND = am.lib.enum.auto()
 
         RESET_SET = am.lib.enum.auto()
+        CONFIG_SET = am.lib.enum.auto()
 
         READ_ADDRESS = am.lib.enum.auto()
         READ_LENGTH = am.lib.enum.auto()
         READ_LOAD = am.lib.enum.auto()
         READ_OUTPUT = am.lib.enum.auto()
 
+        STREAM_NEXT = am.lib.enum.auto()
+        STREAM_END = am.lib.enum.auto()
+
         WRITE_ADDRESS = am.lib.enum.auto()
+        WRITE_LENGTH = am.lib.enum.auto()
+        WRITE_MASK = am.lib.enum.auto()
         WRITE_DATA = am.lib.enum.auto()
         WRITE_STORE = am.lib.enum.auto()
         WRITE_OUTPUT = am.lib.enum.auto()
 
+        CRC_ADDRESS = am.lib.enum.auto()
+        CRC_LENGTH = am.lib.enum.auto()
+        CRC_LOAD = am.lib.enum.auto()
+        CRC_OUTPUT = am.lib.enum.auto()
+
+        SEARCH_ADDRESS = am.lib.enum.auto()
+        SEARCH_LENGTH = am.lib.enum.auto()
+        SEARCH_PATTERN = am.lib.enum.auto()
+        SEARCH_MASK = am.lib.enum.auto()
+        SEARCH_LOAD = am.lib.enum.auto()
+        SEARCH_OUTPUT = am.lib.enum.auto()
+
+        FILL_ADDRESS = am.lib.enum.auto()
+        FILL_LENGTH = am.lib.enum.auto()
+        FILL_DATA = am.lib.enum.auto()
+        FILL_STORE = am.lib.enum.auto()
+
+        COPY_ADDRESS = am.lib.enum.auto()
+        COPY_DEST = am.lib.enum.auto()
+        COPY_LENGTH = am.lib.enum.auto()
+        COPY_LOAD = am.lib.enum.auto()
+        COPY_STORE = am.lib.enum.auto()
+
+        WAIT_ADDRESS = am.lib.enum.auto()
+        WAIT_LENGTH = am.lib.enum.auto()
+        WAIT_PATTERN = am.lib.enum.auto()
+        WAIT_MASK = am.lib.enum.auto()
+        WAIT_LOAD = am.lib.enum.auto()
+        WAIT_IDLE = am.lib.enum.auto()
+        WAIT_OUTPUT = am.lib.enum.auto()
+
     class Command(am.lib.enum.Enum):
         PING = 0
         ERROR = 1
         RESET = 2
         READ = 3
         WRITE = 4
+        CRC = 5
+        SEARCH = 6
+        CONFIG = 7
+        FILL = 8
+        COPY = 9
+        WAIT = 10
+        STREAM = 11
+        # counted WRITE that sends no response at all
+        POST = 12
+
+    # bits or'd into a command byte to change how it works. these are
+    # echoed back in the response
+    class Modifier(am.lib.enum.Flag, shape=8):
+        # WRITE takes a length like READ, instead of running to the end
+        # of the frame, so more commands can follow it
+        COUNTED = 0x80
+        # counted WRITE takes two more bytes after the length, the bus sel
+        # for its first and last words, so it can write any range of bytes
+        MASKED = 0x40
+        # WAIT waits for the value to stop matching, instead of to match
+        INVERT = 0x20
+        # READ and STREAM read the same address over and over, for FIFOs
+        FIXED = 0x10
+
+    # optional protocol features, requested with CONFIG. PING turns them
+    # all off again, so hosts that do not know about them still work
+    class Mode(am.lib.enum.Flag, shape=8):
+        # READ and counted WRITE take 16-bit lengths, and WRITE responds
+        # with a 16-bit count
+        LONG = 0x01
+        # counted WRITE takes the MASKED modifier. this changes nothing,
+        # it is only here so hosts can tell
+        MASKED = 0x02
+        # WAIT is here. like MASKED, this is only so hosts can tell
+        WAIT = 0x04
+        # POST is here, also only so hosts can tell
+        POST = 0x08
+        # responses leave out the addresses echoed from the request, and
+        # READ, STREAM and counted WRITE / POST lengths are sent 7 bits to
+        # a byte, low bits first, with the top bit set on all but the last
+        COMPACT = 0x10
+        # frames end in a tag byte and a CRC-16/XMODEM of the frame, high
+        # byte first, and responses copy the request's tag. this applies
+        # to frames that end with it on, so the last three bytes of each
+        # frame wait until then. requests that fail the check get a bad
+        # CRC back, after an ERROR if nothing else was sent yet. requests
+        # run before they are checked, so a damaged one may have already
+        # written somewhere by then
+        CHECKED = 0x20
+        # CRC, SEARCH, FILL and COPY are here. like MASKED, this changes
+        # nothing, it is only here so hosts can tell
+        BLOCK = 0x40
+
+    # the modes this bridge supports, at most. see __init__
+    _modes = (Mode.LONG | Mode.MASKED | Mode.WAIT | Mode.POST |
+              Mode.COMPACT | Mode.CHECKED | Mode.BLOCK)
 
     def __init__(self, *, addr_width, data_width, granularity=None,
                  features=frozenset(), fifo_depth=16,
@@ -57,6 +152,16 @@ class UartBridge(am.lib.wiring.Component):
         # how many bits granularity occupies
         self._addr_align = am.utils.exact_log2(data_width // granularity)
 
+        # hosts send masks with a bit per byte, which only line up with
+        # bus.sel when it also has a bit per byte
+        self._modes = type(self)._modes
+        if granularity != 8:
+            self._modes &= ~self.Mode.MASKED
+
+        # use incrementing bursts if the bus has what they need
+        self._bursts = {amsoc.wishbone.Feature.CTI,
+                        amsoc.wishbone.Feature.BTE} <= self._features
+
         super().__init__({
             'bus': am.lib.wiring.Out(amsoc.wishbone.Signature(
                 addr_width=addr_width, data_width=data_width,
@@ -117,6 +222,22 @@ class UartBridge(am.lib.wiring.Component):
         am.lib.wiring.connect(m, rxcobs.o_stream, rxfifo.w_stream)
         am.lib.wiring.connect(m, txfifo.r_stream, txcobs.i_stream)
 
+        # frame checks, for CHECKED
+        m.submodules.rxcheck = rxcheck = crc_trailer.Checker(tagged=True)
+        m.submodules.txcheck = txcheck = crc_trailer.Appender(tagged=True)
+
+        # fifos to checks
+        m.d.comb += [
+            rxcheck.i_data.eq(rxfifo.r_data),
+            rxcheck.i_valid.eq(rxfifo.r_stream.valid),
+            rxfifo.r_stream.ready.eq(rxcheck.i_ready),
+            txfifo.w_data.eq(txcheck.o_data),
+            txfifo.w_stream.valid.eq(txcheck.o_valid),
+            txcheck.o_ready.eq(txfifo.w_stream.ready),
+            # responses are tagged like the request they answer
+            txcheck.tag.eq(rxcheck.tag),
+        ]
+
         # initial state
         state = am.Signal(self._State, init=self._State.WAIT_START)
 
@@ -124,25 +245,130 @@ class UartBridge(am.lib.wiring.Component):
         address = am.Signal(self._addr_width)
         address_byte = am.Signal(self._addr_align)
 
+        # second address read in, for COPY
+        dest = am.Signal(self._addr_width)
+
         # length read in, actually this is length - 1
-        length = am.Signal(8)
+        length = am.Signal(self._data_width)
+
+        # Mode flags turned on with CONFIG
+        mode = am.Signal(8)
+        long = (mode & self.Mode.LONG).any()
+        # how many bytes are in a length, minus one
+        length_bytes = am.Mux(long, 1, 0)
+        compact = (mode & self.Mode.COMPACT).any()
+        # where the next 7 bits of a compact length go
+        length_shift = am.Signal(range(self._data_width))
+        checked = (mode & self.Mode.CHECKED).any()
+        m.d.comb += [
+            rxcheck.enable.eq(checked),
+            txcheck.enable.eq(checked),
+        ]
+
+        # the current command byte, with modifiers
+        command = am.Signal(8)
+        posted = command[:4] == self.Command.POST.value
+        counted = (command & self.Modifier.COUNTED).any() | posted
+        # counted WRITE stops after writing this many words (minus one),
+        # and STREAM reads this many words into each frame
+        limit = am.Signal(self._data_width)
+        # bus sel for the first and last words of a WRITE
+        masked = (command & self.Modifier.MASKED).any()
+        sel_first = am.Signal.like(self.bus.sel)
+        sel_last = am.Signal.like(self.bus.sel)
+        all_lanes = (1 << len(self.bus.sel)) - 1
 
         # data read in / storage
         data = am.Signal(self._data_width)
         data_byte = am.Signal(am.utils.exact_log2(self._data_width // 8))
 
+        # the next word for READ, read while the current one goes out
+        prefetch = am.Signal(self._data_width)
+        prefetched = am.Signal()
+        # READ address increments, unless FIXED
+        fixed = (command & self.Modifier.FIXED).any()
+        address_step = am.Mux(fixed, 0, 1)
+
+        # STREAM keeps sending READ frames until the host sends anything
+        stream = am.Signal()
+
+        # WRITE stores words from here while the next one comes in
+        store = am.Signal(self._data_width)
+        store_address = am.Signal(self._addr_width)
+        store_sel = am.Signal.like(self.bus.sel)
+        storing = am.Signal()
+
+        # pattern mask for SEARCH and WAIT, and whether it matched
+        mask = am.Signal(self._data_width)
+        found = am.Signal()
+        inverted = (command & self.Modifier.INVERT).any()
+
+        # crc32 (as in zlib) of little-endian words, for CRC
+        m.submodules.crc = crc = am.lib.crc.catalog.CRC32_ETHERNET(
+            data_width=self._data_width).create()
+        m.d.comb += crc.data.eq(self.bus.dat_r)
+
         # aliases for incoming / outgoing streams
-        i_data_framed = lib.Framed(8)(rxfifo.r_data)
+        i_data_framed = rxcheck.o_data
         i_data = i_data_framed.data
         i_frame = i_data_framed.frame
-        i_valid = rxfifo.r_stream.valid
-        i_ready = rxfifo.r_stream.ready
+        i_valid = rxcheck.o_valid
+        i_ready = rxcheck.o_ready
 
-        o_data_framed = lib.Framed(8)(txfifo.w_data)
+        o_data_framed = am.Signal(lib.Framed(8))
         o_data = o_data_framed.data
         o_frame = o_data_framed.frame
-        o_valid = txfifo.w_stream.valid
-        o_ready = txfifo.w_stream.ready
+        o_valid = am.Signal()
+        o_ready = am.Signal()
+
+        # output is thrown away while this is set
+        quiet = am.Signal()
+        # output frames start on their first byte, so requests with
+        # nothing to say (like POST) get no response frame at all
+        o_started = am.Signal()
+        # an ERROR for a request that failed its check is on its way out
+        erroring = am.Signal()
+
+        m.d.comb += [
+            txcheck.i_data.eq(o_data_framed),
+            txcheck.i_valid.eq(o_valid),
+            o_ready.eq(txcheck.i_ready),
+        ]
+        with m.If(quiet):
+            m.d.comb += [
+                txcheck.i_valid.eq(0),
+                o_ready.eq(1),
+            ]
+        with m.Elif(o_valid & ~o_started):
+            with m.If(o_frame):
+                # the end of a frame that never started
+                m.d.comb += [
+                    txcheck.i_valid.eq(0),
+                    o_ready.eq(1),
+                ]
+            with m.Else():
+                # start the frame, then send this byte
+                m.d.comb += [
+                    txcheck.i_data.frame.eq(1),
+                    o_ready.eq(0),
+                ]
+                with m.If(txcheck.i_ready):
+                    m.d.sync += o_started.eq(1)
+        # kept out of the chain above, which drives o_ready
+        with m.If(~quiet & o_started & o_valid & o_frame & o_ready):
+            m.d.sync += o_started.eq(0)
+
+        # POST sends nothing back
+        with m.If(posted & state.matches(self._State.WRITE_ADDRESS,
+                                         self._State.WRITE_OUTPUT)):
+            m.d.comb += quiet.eq(1)
+        # and COMPACT does not echo addresses
+        with m.If(compact & state.matches(
+                self._State.READ_ADDRESS, self._State.WRITE_ADDRESS,
+                self._State.CRC_ADDRESS, self._State.SEARCH_ADDRESS,
+                self._State.FILL_ADDRESS, self._State.COPY_ADDRESS,
+                self._State.COPY_DEST, self._State.WAIT_ADDRESS)):
+            m.d.comb += quiet.eq(1)
 
         # reasonable defaults overridden below
         m.d.comb += [
@@ -155,19 +381,44 @@ class UartBridge(am.lib.wiring.Component):
             self.bus.dat_w.eq(data),
         ]
 
+        # store WRITE data in the background. nothing else uses the bus
+        # until this is done, because WRITE_OUTPUT waits for it
+        with m.If(storing):
+            m.d.comb += [
+                self.bus.cyc.eq(1),
+                self.bus.stb.eq(1),
+                self.bus.we.eq(1),
+                self.bus.sel.eq(store_sel),
+                self.bus.adr.eq(store_address),
+                self.bus.dat_w.eq(store),
+            ]
+            with m.If(self.bus.ack):
+                m.d.sync += storing.eq(0)
+
+        # bus accesses in a tight loop use incrementing bursts, if we can
+        def burst(last):
+            if self._bursts:
+                m.d.comb += self.bus.bte.eq(amsoc.wishbone.BurstTypeExt.LINEAR)
+                with m.If(last):
+                    m.d.comb += self.bus.cti.eq(
+                        amsoc.wishbone.CycleType.END_OF_BURST)
+                with m.Else():
+                    m.d.comb += self.bus.cti.eq(
+                        amsoc.wishbone.CycleType.INCR_BURST)
+
         with m.Switch(state):
             with m.Case(self._State.WAIT_START):
                 # eat input bytes until we find a frame start
                 m.d.comb += i_ready.eq(1)
+                with m.If(i_valid):
+                    # the host said something, stop any STREAM
+                    m.d.sync += stream.eq(0)
                 with m.If(i_valid & i_frame):
-                    # start output frame and transition to COMMAND on ready
-                    m.d.comb += [
-                        o_frame.eq(1),
-                        o_valid.eq(1),
-                        i_ready.eq(o_ready),
-                    ]
-                    with m.If(o_ready):
-                        m.d.sync += state.eq(self._State.COMMAND)
+                    # the output frame starts by itself, see above
+                    m.d.sync += state.eq(self._State.COMMAND)
+                with m.Elif(stream & ~i_valid):
+                    # start another STREAM frame
+                    m.d.sync += state.eq(self._State.STREAM_NEXT)
 
             with m.Case(self._State.WAIT_END):
                 # eat input bytes until we find a frame end
@@ -192,6 +443,7 @@ class UartBridge(am.lib.wiring.Component):
                         m.d.sync += [
                             state.eq(next_state),
                             address_byte.eq(0),
+                            command.eq(i_data),
                         ]
 
                     # case by case response
@@ -199,8 +451,10 @@ class UartBridge(am.lib.wiring.Component):
                         with m.Case(self.Command.PING):
                             m.d.comb += [
                                 response.eq(self.Command.PING),
-                                next_state.eq(self._State.WAIT_END),
+                                next_state.eq(self._State.COMMAND),
                             ]
+                            with m.If(o_ready):
+                                m.d.sync += mode.eq(0)
                         with m.Case(self.Command.RESET):
                             m.d.comb += [
                                 response.eq(self.Command.RESET),
@@ -211,11 +465,86 @@ class UartBridge(am.lib.wiring.Component):
                                 response.eq(self.Command.READ),
                                 next_state.eq(self._State.READ_ADDRESS),
                             ]
+                        with m.Case(self.Command.READ.value |
+                                    self.Modifier.FIXED.value):
+                            m.d.comb += [
+                                response.eq(self.Command.READ),
+                                next_state.eq(self._State.READ_ADDRESS),
+                                # echo the modifiers too
+                                o_data.eq(i_data),
+                            ]
+                        with m.Case(self.Command.STREAM,
+                                    self.Command.STREAM.value |
+                                    self.Modifier.FIXED.value):
+                            m.d.comb += [
+                                response.eq(self.Command.STREAM),
+                                next_state.eq(self._State.READ_ADDRESS),
+                                # echo the modifiers too
+                                o_data.eq(i_data),
+                            ]
+                            with m.If(o_ready):
+                                m.d.sync += stream.eq(1)
                         with m.Case(self.Command.WRITE):
                             m.d.comb += [
                                 response.eq(self.Command.WRITE),
                                 next_state.eq(self._State.WRITE_ADDRESS),
                             ]
+                        with m.Case(self.Command.WRITE.value |
+                                    self.Modifier.COUNTED.value,
+                                    self.Command.WRITE.value |
+                                    self.Modifier.COUNTED.value |
+                                    self.Modifier.MASKED.value):
+                            m.d.comb += [
+                                response.eq(self.Command.WRITE),
+                                next_state.eq(self._State.WRITE_ADDRESS),
+                                # echo the modifiers too
+                                o_data.eq(i_data),
+                            ]
+                        with m.Case(self.Command.POST,
+                                    self.Command.POST.value |
+                                    self.Modifier.MASKED.value):
+                            m.d.comb += [
+                                next_state.eq(self._State.WRITE_ADDRESS),
+                                quiet.eq(1),
+                            ]
+                        with m.Case(self.Command.CRC):
+                            m.d.comb += [
+                                response.eq(self.Command.CRC),
+                                next_state.eq(self._State.CRC_ADDRESS),
+                            ]
+                        with m.Case(self.Command.SEARCH):
+                            m.d.comb += [
+                                response.eq(self.Command.SEARCH),
+                                next_state.eq(self._State.SEARCH_ADDRESS),
+                            ]
+                        with m.Case(self.Command.FILL):
+                            m.d.comb += [
+                                response.eq(self.Command.FILL),
+                                next_state.eq(self._State.FILL_ADDRESS),
+                            ]
+                        with m.Case(self.Command.COPY):
+                            m.d.comb += [
+                                response.eq(self.Command.COPY),
+                                next_state.eq(self._State.COPY_ADDRESS),
+                            ]
+                        with m.Case(self.Command.WAIT):
+                            m.d.comb += [
+                                response.eq(self.Command.WAIT),
+                                next_state.eq(self._State.WAIT_ADDRESS),
+                            ]
+                        with m.Case(self.Command.WAIT.value |
+                                    self.Modifier.INVERT.value):
+                            m.d.comb += [
+                                response.eq(self.Command.WAIT),
+                                next_state.eq(self._State.WAIT_ADDRESS),
+                                # echo the modifiers too
+                                o_data.eq(i_data),
+                            ]
+                        with m.Case(self.Command.CONFIG):
+                            m.d.comb += [
+                                response.eq(self.Command.CONFIG),
+                                next_state.eq(self._State.CONFIG_SET),
+                            ]
 
             with m.Case(self._State.RESET_SET):
                 # copy flag out, set reset when ready
@@ -228,11 +557,28 @@ class UartBridge(am.lib.wiring.Component):
                     with m.If(o_ready):
                         m.d.sync += [
                             self.reset.eq(i_data.any()),
-                            state.eq(self._State.WAIT_END),
+                            state.eq(self._State.COMMAND),
                         ]
 
-            # double up, these states do basically the same thing
-            with m.Case(self._State.READ_ADDRESS, self._State.WRITE_ADDRESS):
+            with m.Case(self._State.CONFIG_SET):
+                # turn on the requested modes we support, and say which
+                with m.If(i_valid & ~i_frame):
+                    m.d.comb += [
+                        o_data.eq(i_data & self._modes.value),
+                        o_valid.eq(1),
+                        i_ready.eq(o_ready),
+                    ]
+                    with m.If(o_ready):
+                        m.d.sync += [
+                            mode.eq(i_data & self._modes.value),
+                            state.eq(self._State.COMMAND),
+                        ]
+
+            # these states do basically the same thing
+            with m.Case(self._State.READ_ADDRESS, self._State.WRITE_ADDRESS,
+                        self._State.CRC_ADDRESS, self._State.SEARCH_ADDRESS,
+                        self._State.FILL_ADDRESS, self._State.COPY_ADDRESS,
+                        self._State.WAIT_ADDRESS):
                 # copy bytes out and read into address when ready
                 with m.If(i_valid & ~i_frame):
                     m.d.comb += [
@@ -253,22 +599,100 @@ class UartBridge(am.lib.wiring.Component):
                         # if this is the last address byte, move on
                         with m.If(address_byte.all()):
                             with m.If(state.matches(self._State.READ_ADDRESS)):
-                                m.d.sync += state.eq(self._State.READ_LENGTH)
+                                m.d.sync += [
+                                    state.eq(self._State.READ_LENGTH),
+                                    length.eq(0),
+                                    limit.eq(0),
+                                    length_shift.eq(0),
+                                    data_byte.eq(0),
+                                ]
+                            with m.Elif(state.matches(self._State.CRC_ADDRESS)):
+                                m.d.sync += [
+                                    state.eq(self._State.CRC_LENGTH),
+                                    data_byte.eq(0),
+                                ]
+                            with m.Elif(state.matches(
+                                    self._State.SEARCH_ADDRESS)):
+                                m.d.sync += [
+                                    state.eq(self._State.SEARCH_LENGTH),
+                                    data_byte.eq(0),
+                                ]
+                            with m.Elif(state.matches(
+                                    self._State.FILL_ADDRESS)):
+                                m.d.sync += [
+                                    state.eq(self._State.FILL_LENGTH),
+                                    data_byte.eq(0),
+                                ]
+                            with m.Elif(state.matches(
+                                    self._State.COPY_ADDRESS)):
+                                m.d.sync += state.eq(self._State.COPY_DEST)
+                            with m.Elif(state.matches(
+                                    self._State.WAIT_ADDRESS)):
+                                m.d.sync += [
+                                    state.eq(self._State.WAIT_LENGTH),
+                                    data_byte.eq(0),
+                                ]
                             with m.Else(): # WRITE_ADDRESS
                                 m.d.sync += [
                                     state.eq(self._State.WRITE_DATA),
                                     length.eq(0),
+                                    limit.eq(0),
+                                    length_shift.eq(0),
                                     data_byte.eq(0),
+                                    sel_first.eq(all_lanes),
+                                    sel_last.eq(all_lanes),
                                 ]
+                                with m.If(counted):
+                                    m.d.sync += state.eq(
+                                        self._State.WRITE_LENGTH)
+
+            with m.Case(self._State.COPY_DEST):
+                # same as above, but into dest
+                with m.If(i_valid & ~i_frame):
+                    m.d.comb += [
+                        o_data.eq(i_data),
+                        o_valid.eq(1),
+                        i_ready.eq(o_ready),
+                    ]
+                    with m.If(address_byte == 0):
+                        m.d.comb += o_data[:self._addr_align].eq(0)
+                    with m.If(o_ready):
+                        m.d.sync += [
+                            address_byte.eq(address_byte + 1),
+                            dest.eq(dest >> 8),
+                            dest[-8:].eq(i_data),
+                        ]
+                        with m.If(address_byte.all()):
+                            m.d.sync += [
+                                state.eq(self._State.COPY_LENGTH),
+                                data_byte.eq(0),
+                            ]
 
             with m.Case(self._State.READ_LENGTH):
-                # read into length, do not copy out
+                # read into length (and limit), do not copy out
                 m.d.comb += i_ready.eq(1)
                 with m.If(i_valid & ~i_frame):
-                    m.d.sync += [
-                        length.eq(i_data),
-                        state.eq(self._State.READ_LOAD),
-                    ]
+                    last = am.Signal()
+                    with m.If(compact):
+                        m.d.comb += last.eq(~i_data[7])
+                        m.d.sync += [
+                            length_shift.eq(length_shift + 7),
+                            length.bit_select(length_shift, 7).eq(i_data),
+                            limit.bit_select(length_shift, 7).eq(i_data),
+                        ]
+                    with m.Else():
+                        m.d.comb += last.eq(data_byte == length_bytes)
+                        m.d.sync += [
+                            data_byte.eq(data_byte + 1),
+                            length.word_select(data_byte, 8).eq(i_data),
+                            limit.word_select(data_byte, 8).eq(i_data),
+                        ]
+                    with m.If(last):
+                        m.d.sync += state.eq(self._State.READ_LOAD)
+                        # STREAM reads nothing yet, its frames come later.
+                        # the rest of this frame is ignored
+                        with m.If(stream):
+                            m.d.sync += state.eq(self._State.WAIT_END)
 
             with m.Case(self._State.READ_LOAD):
                 # read some data, continue on ack
@@ -283,10 +707,31 @@ class UartBridge(am.lib.wiring.Component):
                     m.d.sync += [
                         data.eq(self.bus.dat_r),
                         data_byte.eq(0),
+                        address.eq(address + address_step),
                         state.eq(self._State.READ_OUTPUT),
                     ]
 
             with m.Case(self._State.READ_OUTPUT):
+                # while this word goes out, read the next one into prefetch
+                # if there is one. the request stays up until ack, even if
+                # we move back to READ_LOAD to wait for it
+                prefetch_ack = am.Signal()
+                with m.If((length != 0) & ~prefetched):
+                    m.d.comb += [
+                        self.bus.cyc.eq(1),
+                        self.bus.stb.eq(1),
+                        self.bus.we.eq(0),
+                        self.bus.sel.eq(-1),
+                        self.bus.adr.eq(address),
+                        prefetch_ack.eq(self.bus.ack),
+                    ]
+                    with m.If(self.bus.ack):
+                        m.d.sync += [
+                            prefetch.eq(self.bus.dat_r),
+                            prefetched.eq(1),
+                            address.eq(address + address_step),
+                        ]
+
                 # write a byte of data out and advance when ready
                 m.d.comb += [
                     o_data.eq(data[:8]),
@@ -297,22 +742,100 @@ class UartBridge(am.lib.wiring.Component):
                         data.eq(data >> 8),
                         data_byte.eq(data_byte + 1),
                     ]
-                    # if we're at the end, read another
+                    # if we're at the end, use the prefetched word or wait
+                    # for it in READ_LOAD
                     with m.If(data_byte.all()):
                         m.d.sync += [
                             state.eq(self._State.READ_LOAD),
-                            address.eq(address + 1),
                             length.eq(length - 1),
                         ]
+                        with m.If(prefetched):
+                            m.d.sync += [
+                                data.eq(prefetch),
+                                prefetched.eq(0),
+                                state.eq(self._State.READ_OUTPUT),
+                            ]
+                        with m.Elif(prefetch_ack):
+                            m.d.sync += [
+                                data.eq(self.bus.dat_r),
+                                prefetched.eq(0),
+                                state.eq(self._State.READ_OUTPUT),
+                            ]
                         # if no more addresses, end command
                         with m.If(length == 0):
-                            m.d.sync += state.eq(self._State.WAIT_END)
+                            m.d.sync += state.eq(self._State.COMMAND)
+                            with m.If(stream):
+                                m.d.sync += state.eq(self._State.STREAM_END)
+
+            with m.Case(self._State.STREAM_NEXT):
+                # STREAM frames start with the command, then go like READ
+                m.d.comb += [
+                    o_data.eq(command),
+                    o_valid.eq(1),
+                ]
+                with m.If(o_ready):
+                    m.d.sync += [
+                        length.eq(limit),
+                        state.eq(self._State.READ_LOAD),
+                    ]
+
+            with m.Case(self._State.STREAM_END):
+                # end output frame and go look for the next one on ready
+                m.d.comb += [
+                    o_data.eq(0),
+                    o_frame.eq(1),
+                    o_valid.eq(1),
+                ]
+                with m.If(o_ready):
+                    m.d.sync += state.eq(self._State.WAIT_START)
+
+            with m.Case(self._State.WRITE_LENGTH):
+                # read into limit, do not copy out
+                m.d.comb += i_ready.eq(1)
+                with m.If(i_valid & ~i_frame):
+                    last = am.Signal()
+                    with m.If(compact):
+                        m.d.comb += last.eq(~i_data[7])
+                        m.d.sync += [
+                            length_shift.eq(length_shift + 7),
+                            limit.bit_select(length_shift, 7).eq(i_data),
+                        ]
+                    with m.Else():
+                        m.d.comb += last.eq(data_byte == length_bytes)
+                        m.d.sync += [
+                            data_byte.eq(data_byte + 1),
+                            limit.word_select(data_byte, 8).eq(i_data),
+                        ]
+                    with m.If(last):
+                        m.d.sync += [
+                            data_byte.eq(0),
+                            state.eq(self._State.WRITE_DATA),
+                        ]
+                        with m.If(masked):
+                            m.d.sync += state.eq(self._State.WRITE_MASK)
+
+            with m.Case(self._State.WRITE_MASK):
+                # read sel for the first and last words, do not copy out
+                m.d.comb += i_ready.eq(1)
+                with m.If(i_valid & ~i_frame):
+                    m.d.sync += data_byte.eq(data_byte + 1)
+                    with m.If(data_byte == 0):
+                        m.d.sync += sel_first.eq(i_data)
+                    with m.Else():
+                        m.d.sync += [
+                            sel_last.eq(i_data),
+                            data_byte.eq(0),
+                            state.eq(self._State.WRITE_DATA),
+                        ]
 
             with m.Case(self._State.WRITE_DATA):
                 # read into data, do not copy out
                 with m.If(i_valid & i_frame):
                     # no more data, jump to end
-                    m.d.sync += state.eq(self._State.WRITE_OUTPUT)
+                    m.d.sync += [
+                        data_byte.eq(0),
+                        state.eq(self._State.WRITE_OUTPUT),
+                    ]
                 # still more data
                 with m.If(i_valid & ~i_frame):
                     m.d.comb += i_ready.eq(1)
@@ -326,44 +849,300 @@ class UartBridge(am.lib.wiring.Component):
                         m.d.sync += state.eq(self._State.WRITE_STORE)
 
             with m.Case(self._State.WRITE_STORE):
-                # write some data, continue on ack
+                # hand the data off to be stored, once the last word is done
+                with m.If(~storing | self.bus.ack):
+                    m.d.sync += [
+                        store.eq(data),
+                        store_address.eq(address),
+                        store_sel.eq(
+                            am.Mux(length == 0, sel_first, all_lanes) &
+                            am.Mux(length == limit, sel_last, all_lanes)),
+                        storing.eq(1),
+                        state.eq(self._State.WRITE_DATA),
+                        address.eq(address + 1),
+                        length.eq(length + 1),
+                    ]
+                    # counted writes end after the last word
+                    with m.If(counted & (length == limit)):
+                        m.d.sync += state.eq(self._State.WRITE_OUTPUT)
+
+            with m.Case(self._State.WRITE_OUTPUT):
+                # write the amount written to output, once it is written
+                with m.If(~storing):
+                    m.d.comb += [
+                        o_data.eq(length.word_select(data_byte, 8)),
+                        o_valid.eq(1),
+                    ]
+                    with m.If(o_ready):
+                        m.d.sync += data_byte.eq(data_byte + 1)
+                        with m.If(data_byte == length_bytes):
+                            m.d.sync += state.eq(self._State.COMMAND)
+
+            with m.Case(self._State.CRC_LENGTH, self._State.SEARCH_LENGTH,
+                        self._State.FILL_LENGTH, self._State.COPY_LENGTH,
+                        self._State.WAIT_LENGTH):
+                # read a full word into length, do not copy out
+                m.d.comb += i_ready.eq(1)
+                with m.If(i_valid & ~i_frame):
+                    m.d.sync += [
+                        data_byte.eq(data_byte + 1),
+                        length.eq(length >> 8),
+                        length[-8:].eq(i_data),
+                    ]
+                    # if this is the last length byte, move on
+                    with m.If(data_byte.all()):
+                        with m.If(state.matches(self._State.CRC_LENGTH)):
+                            # start a new crc
+                            m.d.comb += crc.start.eq(1)
+                            m.d.sync += state.eq(self._State.CRC_LOAD)
+                        with m.Elif(state.matches(self._State.SEARCH_LENGTH)):
+                            m.d.sync += state.eq(self._State.SEARCH_PATTERN)
+                        with m.Elif(state.matches(self._State.WAIT_LENGTH)):
+                            m.d.sync += state.eq(self._State.WAIT_PATTERN)
+                        with m.Elif(state.matches(self._State.FILL_LENGTH)):
+                            m.d.sync += state.eq(self._State.FILL_DATA)
+                        with m.Else(): # COPY_LENGTH
+                            m.d.sync += state.eq(self._State.COPY_LOAD)
+
+            with m.Case(self._State.CRC_LOAD):
+                # read some data into the crc, continue on ack
                 m.d.comb += [
                     self.bus.cyc.eq(1),
                     self.bus.stb.eq(1),
-                    self.bus.we.eq(1),
+                    self.bus.we.eq(0),
                     self.bus.sel.eq(-1),
                     self.bus.adr.eq(address),
-                    self.bus.dat_w.eq(data),
                 ]
+                burst(length == 0)
                 with m.If(self.bus.ack):
+                    m.d.comb += crc.valid.eq(1)
                     m.d.sync += [
-                        state.eq(self._State.WRITE_DATA),
                         address.eq(address + 1),
-                        length.eq(length + 1),
+                        length.eq(length - 1),
                     ]
+                    # if no more addresses, output the crc
+                    with m.If(length == 0):
+                        m.d.sync += [
+                            data_byte.eq(0),
+                            state.eq(self._State.CRC_OUTPUT),
+                        ]
 
-            with m.Case(self._State.WRITE_OUTPUT):
-                # write the amount written to output
+            with m.Case(self._State.CRC_OUTPUT):
+                # write a byte of the crc out and advance when ready
                 m.d.comb += [
-                    o_data.eq(length),
+                    o_data.eq(crc.crc.word_select(data_byte, 8)),
                     o_valid.eq(1),
                 ]
                 with m.If(o_ready):
-                    m.d.sync += state.eq(self._State.WAIT_END)
+                    m.d.sync += data_byte.eq(data_byte + 1)
+                    with m.If(data_byte.all()):
+                        m.d.sync += state.eq(self._State.COMMAND)
+
+            with m.Case(self._State.SEARCH_PATTERN, self._State.FILL_DATA,
+                        self._State.WAIT_PATTERN):
+                # read a full word into data, do not copy out
+                m.d.comb += i_ready.eq(1)
+                with m.If(i_valid & ~i_frame):
+                    m.d.sync += [
+                        data_byte.eq(data_byte + 1),
+                        data.eq(data >> 8),
+                        data[-8:].eq(i_data),
+                    ]
+                    with m.If(data_byte.all()):
+                        with m.If(state.matches(self._State.SEARCH_PATTERN)):
+                            m.d.sync += state.eq(self._State.SEARCH_MASK)
+                        with m.Elif(state.matches(self._State.WAIT_PATTERN)):
+                            m.d.sync += state.eq(self._State.WAIT_MASK)
+                        with m.Else(): # FILL_DATA
+                            m.d.sync += state.eq(self._State.FILL_STORE)
+
+            with m.Case(self._State.SEARCH_MASK, self._State.WAIT_MASK):
+                # read a full word into mask, do not copy out
+                m.d.comb += i_ready.eq(1)
+                with m.If(i_valid & ~i_frame):
+                    m.d.sync += [
+                        data_byte.eq(data_byte + 1),
+                        mask.eq(mask >> 8),
+                        mask[-8:].eq(i_data),
+                    ]
+                    with m.If(data_byte.all()):
+                        with m.If(state.matches(self._State.SEARCH_MASK)):
+                            m.d.sync += state.eq(self._State.SEARCH_LOAD)
+                        with m.Else(): # WAIT_MASK
+                            m.d.sync += state.eq(self._State.WAIT_LOAD)
+
+            with m.Case(self._State.SEARCH_LOAD):
+                # read a word and compare it to the pattern on ack. a match
+                # ends any burst early, which the bus has to put up with
+                m.d.comb += [
+                    self.bus.cyc.eq(1),
+                    self.bus.stb.eq(1),
+                    self.bus.we.eq(0),
+                    self.bus.sel.eq(-1),
+                    self.bus.adr.eq(address),
+                ]
+                burst(length == 0)
+                with m.If(self.bus.ack):
+                    with m.If(((self.bus.dat_r ^ data) & mask) == 0):
+                        # found it, stay at this address
+                        m.d.sync += [
+                            found.eq(1),
+                            state.eq(self._State.SEARCH_OUTPUT),
+                        ]
+                    with m.Else():
+                        m.d.sync += [
+                            address.eq(address + 1),
+                            length.eq(length - 1),
+                        ]
+                        # if no more addresses, give up
+                        with m.If(length == 0):
+                            m.d.sync += [
+                                found.eq(0),
+                                state.eq(self._State.SEARCH_OUTPUT),
+                            ]
+
+            with m.Case(self._State.WAIT_LOAD, self._State.WAIT_IDLE):
+                # length counts down clock cycles until we give up
+                with m.If(length != 0):
+                    m.d.sync += length.eq(length - 1)
+
+                # let go of the bus for a cycle between reads, so whatever
+                # we are waiting on can get to it
+                with m.If(state.matches(self._State.WAIT_IDLE)):
+                    m.d.sync += state.eq(self._State.WAIT_LOAD)
+
+                # read a word and compare it to the pattern on ack
+                with m.Else():
+                    m.d.comb += [
+                        self.bus.cyc.eq(1),
+                        self.bus.stb.eq(1),
+                        self.bus.we.eq(0),
+                        self.bus.sel.eq(-1),
+                        self.bus.adr.eq(address),
+                    ]
+                    with m.If(self.bus.ack):
+                        matched = ((self.bus.dat_r ^ data) & mask) == 0
+                        m.d.sync += state.eq(self._State.WAIT_IDLE)
+                        # stop if it matched or we ran out of time
+                        with m.If((matched ^ inverted) | (length == 0)):
+                            m.d.sync += [
+                                data.eq(self.bus.dat_r),
+                                found.eq(matched ^ inverted),
+                                state.eq(self._State.WAIT_OUTPUT),
+                            ]
+
+            with m.Case(self._State.SEARCH_OUTPUT, self._State.WAIT_OUTPUT):
+                # write out whether we found it, then the address (or for
+                # WAIT, the last value read)
+                m.d.comb += [
+                    o_data.eq(found),
+                    o_valid.eq(1),
+                ]
+                with m.If(o_ready):
+                    # which goes out just like a one word READ
+                    m.d.sync += [
+                        data_byte.eq(0),
+                        length.eq(0),
+                        state.eq(self._State.READ_OUTPUT),
+                    ]
+                    with m.If(state.matches(self._State.SEARCH_OUTPUT)):
+                        m.d.sync += data.eq(address << self._addr_align)
+
+            with m.Case(self._State.FILL_STORE):
+                # write data to every address, continue on ack
+                m.d.comb += [
+                    self.bus.cyc.eq(1),
+                    self.bus.stb.eq(1),
+                    self.bus.we.eq(1),
+                    self.bus.sel.eq(-1),
+                    self.bus.adr.eq(address),
+                    self.bus.dat_w.eq(data),
+                ]
+                burst(length == 0)
+                with m.If(self.bus.ack):
+                    m.d.sync += [
+                        address.eq(address + 1),
+                        length.eq(length - 1),
+                    ]
+                    # if no more addresses, end command
+                    with m.If(length == 0):
+                        m.d.sync += state.eq(self._State.COMMAND)
+
+            with m.Case(self._State.COPY_LOAD):
+                # read a word from address, continue on ack
+                m.d.comb += [
+                    self.bus.cyc.eq(1),
+                    self.bus.stb.eq(1),
+                    self.bus.we.eq(0),
+                    self.bus.sel.eq(-1),
+                    self.bus.adr.eq(address),
+                ]
+                with m.If(self.bus.ack):
+                    m.d.sync += [
+                        data.eq(self.bus.dat_r),
+                        address.eq(address + 1),
+                        state.eq(self._State.COPY_STORE),
+                    ]
+
+            with m.Case(self._State.COPY_STORE):
+                # write it to dest, continue on ack
+                m.d.comb += [
+                    self.bus.cyc.eq(1),
+                    self.bus.stb.eq(1),
+                    self.bus.we.eq(1),
+                    self.bus.sel.eq(-1),
+                    self.bus.adr.eq(dest),
+                    self.bus.dat_w.eq(data),
+                ]
+                with m.If(self.bus.ack):
+                    m.d.sync += [
+                        dest.eq(dest + 1),
+                        length.eq(length - 1),
+                        state.eq(self._State.COPY_LOAD),
+                    ]
+                    # if no more addresses, end command
+                    with m.If(length == 0):
+                        m.d.sync += state.eq(self._State.COMMAND)
 
         # catch all frame boundaries in states that read from i_data
         # except WAIT_START and WRITE_DATA which both handle themselves
         with m.If(state.matches(
                 self._State.WAIT_END, self._State.COMMAND,
-                self._State.RESET_SET, self._State.READ_ADDRESS,
-                self._State.READ_LENGTH, self._State.WRITE_ADDRESS)):
+                self._State.RESET_SET, self._State.CONFIG_SET,
+                self._State.READ_ADDRESS,
+                self._State.READ_LENGTH, self._State.WRITE_ADDRESS,
+                self._State.WRITE_LENGTH, self._State.WRITE_MASK,
+                self._State.CRC_ADDRESS, self._State.CRC_LENGTH,
+                self._State.SEARCH_ADDRESS, self._State.SEARCH_LENGTH,
+                self._State.SEARCH_PATTERN, self._State.SEARCH_MASK,
+                self._State.FILL_ADDRESS, self._State.FILL_LENGTH,
+                self._State.FILL_DATA,
+                self._State.COPY_ADDRESS, self._State.COPY_DEST,
+                self._State.COPY_LENGTH,
+                self._State.WAIT_ADDRESS, self._State.WAIT_LENGTH,
+                self._State.WAIT_PATTERN, self._State.WAIT_MASK)):
 
-            with m.If(i_valid & i_frame):
-                # end output frame and transition to WAIT_START on ready
+            with m.If(i_valid & i_frame & i_data[0] &
+                      (~o_started | erroring)):
+                # the request failed its check, and nothing has been sent
+                # back yet. send an ERROR, so there is a frame to fail
+                m.d.comb += [
+                    o_data.eq(self.Command.ERROR),
+                    o_valid.eq(1),
+                    quiet.eq(0),
+                ]
+                m.d.sync += erroring.eq(1)
+                with m.If(o_ready):
+                    m.d.sync += erroring.eq(0)
+            with m.Elif(i_valid & i_frame):
+                # end output frame and transition to WAIT_START on ready.
+                # the frame word says whether the request failed its
+                # check, and the response fails its own to match
                 m.d.comb += [
                     o_frame.eq(1),
                     o_valid.eq(1),
                     i_ready.eq(o_ready),
+                    quiet.eq(0),
                 ]
                 with m.If(o_ready):
                     m.d.sync += state.eq(self._State.WAIT_START)
@@ -1,236 +1,991 @@
+import array
+import asyncio
+import binascii
+import collections
+import contextlib
 import functools
+import hashlib
 import io
+import itertools
+import json
+import mmap
+import os
+import selectors
+import stat
 import struct
 import subprocess
 import sys
 import time
+import zlib
 
 import click
 import cobs.cobs
+from elftools.elf.constants import P_FLAGS
 from elftools.elf.elffile import ELFFile
 import serial
 
 import alegria.cli
 import alegria.soc
 
-__all__ = ['Bridge', 'SerialBridge', 'ProcessBridge']
+__all__ = [
+    'Bridge', 'SerialBridge', 'ProcessBridge',
+    'AsyncBridge', 'AsyncSerialBridge', 'AsyncProcessBridge',
+]
+
+# compiled little-endian structs, by format. chunked transfers use the
+# same few formats over and over, so these are worth keeping around. odd
+# sizes (RTT spans, the ends of transfers) come and go, so keep a few
+@functools.lru_cache(maxsize=256)
+def _struct(fmt):
+    return struct.Struct('<' + fmt)
+
+# array typecode for unsigned words of the given size in bytes
+@functools.cache
+def _array_typecode(size):
+    for typecode in 'BHILQ':
+        if array.array(typecode).itemsize == size:
+            return typecode
+    raise ValueError(f'no array type for {size} byte words')
+
+# a frame damaged or lost on the way, as opposed to an error reported by
+# the bridge. with CHECKED, these are worth sending again
+class _FrameError(RuntimeError):
+    pass
+
+# incremental cobs deframer. raw bytes go in with feed(), and complete
+# decoded frames come out of pop(). the buffer always starts on a frame
+# delimiter (or is empty), and each byte is only scanned once.
+class _Deframer:
+    def __init__(self):
+        self._buffer = bytearray()
+        # everything before here is known not to be a delimiter
+        self._scan = 1
+
+    def feed(self, data):
+        if not self._buffer:
+            # discard any data before the first 0
+            first = data.find(0)
+            if first < 0:
+                return
+            data = memoryview(data)[first:]
+        self._buffer += data
 
-class Bridge:
-    Command = alegria.soc.UartBridge.Command
+    def pop(self):
+        while True:
+            end = self._buffer.find(0, self._scan)
+            if end < 0:
+                self._scan = max(len(self._buffer), 1)
+                return None
 
-    def __init__(self, debug=False):
-        self._received = b''
+            frame = self._buffer[1:end]
+            # keep the end delimiter, it may also start the next frame.
+            # deleting from the front of a bytearray does not copy
+            del self._buffer[:end]
+            self._scan = 1
+            if frame:
+                try:
+                    return cobs.cobs.decode(frame)
+                except cobs.cobs.DecodeError:
+                    raise _FrameError('bad frame')
+
+_RTT_MAGIC = b'SEGGER RTT\0\0\0\0\0\0'
+
+# crc32 of a + b, from crc32(a), crc32(b) and len(b). crc32 is affine,
+# so this is crc32(a + zeros) ^ crc32(zeros) ^ crc32(b)
+def _crc32_combine(crc_a, crc_b, length_b):
+    zeros = memoryview(bytes(min(length_b, 0x10000)))
+    crc_zeros = zlib.crc32(b'')
+    while length_b:
+        size = min(length_b, len(zeros))
+        crc_a = zlib.crc32(zeros[:size], crc_a)
+        crc_zeros = zlib.crc32(zeros[:size], crc_zeros)
+        length_b -= size
+    return crc_a ^ crc_zeros ^ crc_b
+
+# look for the RTT magic in chunk, read from address, with tail the end
+# of the chunk before it. returns (address of the magic or None, tail)
+def _find_rtt_magic(address, tail, chunk):
+    data = tail + chunk
+    index = data.find(_RTT_MAGIC)
+    if index >= 0:
+        return (address - len(tail) + index, b'')
+    return (None, data[len(data) - len(_RTT_MAGIC) + 1:])
+
+# adaptive poll timing. poll again right away while data keeps arriving,
+# and back off exponentially up to max_delay while idle. also keeps
+# statistics since the last reset_stats()
+class _Poller:
+    def __init__(self, min_delay=0.001, max_delay=0.05, factor=2):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        # seconds to wait before the next poll
+        self.delay = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.polls = 0
+        self.bytes = 0
+        self._stats_start = time.monotonic()
+
+    # record the result of a poll that found amount bytes
+    def record(self, amount):
+        self.polls += 1
+        self.bytes += amount
+        if amount:
+            self.delay = 0
+        else:
+            self.delay = min(max(self.delay * self.factor, self.min_delay),
+                             self.max_delay)
+
+    def elapsed(self):
+        return max(time.monotonic() - self._stats_start, 1e-9)
+
+    def poll_rate(self):
+        return self.polls / self.elapsed()
+
+    def byte_rate(self):
+        return self.bytes / self.elapsed()
+
+# address of a symbol in an ELF, or None
+def _elf_symbol(elf, name):
+    symtab = elf.get_section_by_name('.symtab')
+    if symtab is None:
+        return None
+    symbols = symtab.get_symbol_by_name(name)
+    if not symbols:
+        return None
+    return symbols[0]['st_value']
+
+# (start, end) of every writable segment in an ELF. the RTT block lives
+# in one of these, so there is no need to scan anywhere else
+def _elf_writable_ranges(elf):
+    for seg in elf.iter_segments():
+        if seg['p_type'] != 'PT_LOAD' or not seg['p_flags'] & P_FLAGS.PF_W:
+            continue
+        if seg['p_memsz']:
+            yield (seg['p_vaddr'], seg['p_vaddr'] + seg['p_memsz'])
+
+def _elf_digest(elf):
+    elf.stream.seek(0)
+    return hashlib.sha256(elf.stream.read()).hexdigest()
+
+# persistent RTT addresses, keyed by ELF digest. this is only ever a
+# hint, so any problem reading or writing it is ignored
+class _RttCache:
+    max_entries = 64
+
+    def __init__(self, path=None):
+        if path is None:
+            base = os.environ.get('XDG_CACHE_HOME')
+            if not base:
+                base = os.path.join(os.path.expanduser('~'), '.cache')
+            path = os.path.join(base, 'alegria', 'rtt.json')
+        self.path = path
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(entries, dict):
+            return {}
+        return entries
+
+    def get(self, digest):
+        address = self._load().get(digest)
+        if not isinstance(address, int):
+            return None
+        return address
+
+    def set(self, digest, address):
+        entries = self._load()
+        # most recent last, drop the oldest
+        entries.pop(digest, None)
+        entries[digest] = address
+        while len(entries) > self.max_entries:
+            del entries[next(iter(entries))]
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = f'{self.path}.{os.getpid()}'
+            with open(tmp, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+# operations shared by Bridge and AsyncBridge are written as generators
+# that yield (method, *args) for each bit of i/o they need, and are sent
+# back the result. each front end runs them with _run(), so on Bridge
+# these return their result, and on AsyncBridge, a coroutine for it.
+# methods on RTT objects are run by their bridge
+def _driven(method):
+    @functools.wraps(method)
+    def run(self, *args, **kwargs):
+        bridge = getattr(self, '_bridge', self)
+        return bridge._run(method(self, *args, **kwargs))
+    return run
+
+# the protocol details shared by Bridge and AsyncBridge, without any i/o
+class _BridgeBase:
+    Command = alegria.soc.UartBridge.Command
+    Modifier = alegria.soc.UartBridge.Modifier
+    Mode = alegria.soc.UartBridge.Mode
+
+    # queues up commands to send together, many to a frame. the bridge
+    # answers with all the responses in one frame
+    class Batch:
+        # the result of something queued on a batch, available once the
+        # batch has been flushed
+        class Result:
+            def __init__(self, combine):
+                self._combine = combine
+                self._parts = []
+                self._done = False
+
+            def result(self):
+                if not self._done:
+                    raise RuntimeError('batch has not been flushed')
+                return self._combine(self._parts)
+
+        def __init__(self, bridge):
+            self._bridge = bridge
+            # (command, r_fmt, w_fmt, args, result, check) for each call
+            self._calls = []
+
+        # queue a call. check turns the response into a part of result
+        def _queue(self, result, check, command, r_fmt, w_fmt, *args):
+            self._calls.append((command, r_fmt, w_fmt, args, result, check))
+
+        def call(self, command, r_fmt, w_fmt, *args):
+            result = self.Result(lambda parts: parts[0])
+            self._queue(result, lambda r: r, command, r_fmt, w_fmt, *args)
+            return result
+
+        def ping(self):
+            bridge = self._bridge
+            command = bridge.Command.CONFIG
+            # PING turns off all modes, so turn the current ones back on
+            result = self.call(bridge.Command.PING, '', '')
+            if not bridge.mode:
+                return result
+
+            def check(response):
+                if response != [bridge.mode.value]:
+                    raise RuntimeError(f'bad response to {command}')
+
+            self._queue(self.Result(lambda parts: None), check,
+                        command, 'B', 'B', bridge.mode.value)
+            return result
+
+        def reset(self, value):
+            value = 1 if value else 0
+            command = self._bridge.Command.RESET
+
+            def check(response):
+                if response != [value]:
+                    raise RuntimeError(f'bad response to {command}')
+
+            result = self.Result(lambda parts: None)
+            self._queue(result, check, command, 'B', 'B', value)
+            return result
+
+        def read_words(self, address, amount):
+            bridge = self._bridge
+            bridge._check_aligned(address)
+
+            result = self.Result(lambda parts: list(itertools.chain(*parts)))
+            for addr, size in bridge._split(address, amount, bridge._read_size):
+                def check(response, addr=addr, size=size):
+                    raddr, *chunk = response
+                    if raddr != addr or len(chunk) != size:
+                        raise RuntimeError(f'bad response to {bridge.Command.READ}')
+                    return chunk
+
+                # note: length on the wire is size - 1
+                self._queue(result, check, bridge.Command.READ, f'I{size}I',
+                            f'I{bridge._length_fmt}', addr, size - 1)
+            return result
+
+        def write_words(self, address, words):
+            bridge = self._bridge
+            bridge._check_aligned(address)
+            command = bridge.Command.WRITE.value | bridge.Modifier.COUNTED.value
+            if not bridge._multi:
+                # a plain WRITE runs to the end of the frame, which is
+                # fine when it has the frame to itself
+                command = bridge.Command.WRITE
+
+            result = self.Result(lambda parts: None)
+            words = list(words)
+            for addr, size in bridge._split(address, len(words),
+                                            bridge._write_size):
+                def check(response, addr=addr, size=size):
+                    if response != [addr, size % bridge._length_mod]:
+                        raise RuntimeError(f'bad response to {bridge.Command.WRITE}')
+
+                start = (addr - address) // bridge.word_size
+                chunk = words[start:start + size]
+                length_fmt = bridge._length_fmt
+                if not bridge._multi:
+                    self._queue(result, check, command, f'I{length_fmt}',
+                                f'I{size}I', addr, *chunk)
+                    continue
+                # counted writes have a length, like READ
+                self._queue(result, check, command, f'I{length_fmt}',
+                            f'I{length_fmt}{size}I', addr, size - 1, *chunk)
+            return result
+
+        # group the queued calls into frames, as (frame, calls, slack).
+        # bridges without multi-command frames get one call in each
+        def _frames(self):
+            bridge = self._bridge
+            frame = bytearray()
+            calls = []
+            slack = 0
+            for call in self._calls:
+                command, r_fmt, w_fmt, args, _, _ = call
+                request = bridge._pack_call(command, w_fmt, *args)
+                # the bridge has no flow control. while it sends a response
+                # longer than its request, the rest of the frame waits in
+                # its rx fifo, so keep that from overflowing. the end of
+                # the frame comes in after the last call, so count it too
+                extra = max(0, bridge._response_size(command, r_fmt) -
+                            len(request))
+                end = bridge._framing(len(frame) + len(request))
+                if calls and (not bridge._multi or
+                              slack + extra + end > bridge._batch_slack):
+                    yield (bytes(frame), calls, slack)
+                    frame = bytearray()
+                    calls = []
+                    slack = 0
+                frame += request
+                calls.append(call)
+                slack += extra
+            if calls:
+                yield (bytes(frame), calls, slack)
+
+        # split the frames into groups that can be pipelined, as lists of
+        # (frame, calls). for the same reason as above, frames sent while
+        # others are still answering wait in the rx fifo, and this adds up
+        # over every frame in flight. so the slack of a group, ends and
+        # all, is kept to the same budget, and nothing is sent after a
+        # group until all of it has been answered
+        def _groups(self):
+            bridge = self._bridge
+            group = []
+            total = 0
+            for frame, calls, slack in self._frames():
+                if slack:
+                    slack += bridge._framing(len(frame))
+                if group and total + slack > bridge._batch_slack:
+                    yield group
+                    group = []
+                    total = 0
+                group.append((frame, calls))
+                total += slack
+            if group:
+                yield group
+
+        # split a response frame up between the calls in it
+        def _finish(self, calls, frame):
+            bridge = self._bridge
+            offset = 0
+            for command, r_fmt, _, args, result, check in calls:
+                size = bridge._response_size(command, r_fmt)
+                response = bridge._unpack_call(
+                    command, r_fmt, frame[offset:offset + size], args)
+                result._parts.append(check(response))
+                offset += size
+            if offset != len(frame):
+                raise RuntimeError('bad response to batch')
+
+        def _done(self):
+            for *_, result, _ in self._calls:
+                result._done = True
+            self._calls = []
+
+    # modes asked for when none are given. CHECKED costs three bytes a
+    # frame, so it is left to the user
+    _default_modes = (Mode.LONG | Mode.MASKED | Mode.WAIT | Mode.POST |
+                      Mode.COMPACT | Mode.BLOCK)
+
+    def __init__(self, debug=False, window=1, timeout=None, modes=None,
+                 retries=3):
+        self._deframer = _Deframer()
         self._debug = debug
-        self._read_size = 0x100
-        self._write_size = 0xff
+        # seconds to wait for a response before giving up, or None. this
+        # counts from the last data to arrive, so long responses have as
+        # long as they need, so long as they keep coming
+        self.timeout = timeout
+        # how many requests to keep in flight when pipelining. the bridge
+        # handles frames strictly in order, but requests wait in its rx
+        # fifo, so this is limited by the bridge fifo_depth
+        if window < 1:
+            raise ValueError('window must be at least 1')
+        self.window = window
+        # modes to ask for in ping(), and the ones the bridge agreed to
+        if modes is None:
+            modes = self._default_modes
+        self.modes = self.Mode(modes)
+        self._set_mode(self.Mode(0))
+        # whether the bridge takes more than one command in a frame. this
+        # is found out by ping(), and batches send one call a frame until
+        self._multi = False
+        # with CHECKED, how many times to send a request again when its
+        # response is damaged or lost, and the tag for the next one
+        self.retries = retries
+        self._tag = 0
+        # how far batch frames in flight may get ahead of their responses,
+        # in bytes. this is the bridge's default fifo_depth
+        self._batch_slack = 16
+        # clock cycles each WAIT lasts when waiting forever, at most and
+        # at least. see _wait_budget
+        self._wait_cycles = 1 << 22
+        self._wait_cycles_min = 1 << 12
+        # words each SEARCH, CRC or FILL covers, at most and at least.
+        # see _block_budget
+        self._block_words = 1 << 30
+        self._block_words_min = 1 << 12
+        # seconds between reads when waiting without WAIT
+        self._wait_delay = 0.01
+        # seconds to wait for the RTT magic to show up where the ELF says
+        self._rtt_timeout = 1.0
         self.word_size = 4
         self.word_bits = 32
 
-    def close(self):
-        raise NotImplementedError
-
-    def read_raw(self):
-        raise NotImplementedError
-
-    def write_raw(self, data):
-        raise NotImplementedError
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, typ, value, traceback):
-        self.close()
+    def _set_mode(self, mode):
+        self.mode = mode
+        # READ / WRITE lengths on the wire. write chunks stop one short so
+        # the count in the response is never ambiguous
+        self._length_fmt = 'H' if self.Mode.LONG in mode else 'B'
+        self._length_mod = 1 << (8 * _struct(self._length_fmt).size)
+        self._read_size = self._length_mod
+        self._write_size = self._length_mod - 1
+
+    # PING, and ask for self.modes at the same time. bridges without
+    # CONFIG stop at the PING, or answer it with ERROR.
+    #
+    # this never has a tag and crc. a bridge still CHECKED from before
+    # holds back the last three bytes until the frame ends, so the first
+    # PING turns that off in time for the rest to go through as they are
+    def _pack_ping(self):
+        return _struct('BBBB').pack(
+            self.Command.PING.value, self.Command.PING.value,
+            self.Command.CONFIG.value, self.modes.value)
+
+    # takes the frame as it came in, which has a tag and crc only if the
+    # bridge agreed to CHECKED
+    def _unpack_ping(self, frame):
+        ping = bytes([self.Command.PING.value] * 2)
+        config = self.Command.CONFIG.value
+        checked = (len(frame) > 3 and frame[2] == config and
+                   frame[3] & self.Mode.CHECKED.value)
+        _, frame = self._check_frame(frame, checked=bool(checked))
+        # bridges without multi-command frames stop at the first PING
+        if frame[:2] != ping and frame != ping[:1]:
+            raise RuntimeError(f'bad response to {self.Command.PING}')
+        self._multi = frame[:2] == ping
+        if len(frame) == 4 and frame[2] == config:
+            self._set_mode(self.Mode(frame[3]) & self.modes)
+        else:
+            self._set_mode(self.Mode(0))
 
     def trace(self, msg, **kwargs):
         if self._debug:
             print(msg, file=sys.stderr, **kwargs)
 
-    def read_frame(self):
-        while True:
-            if len(self._received) >= 2:
-                if self._received[0] == 0  and 0 in self._received[1:]:
-                    frame, self._received = self._received[1:].split(b'\x00', 1)
-                    if frame:
-                        decoded = cobs.cobs.decode(frame)
-                        self.trace(f'<<< {decoded}')
-                        if decoded and decoded[0] == self.Command.ERROR:
-                            # error
-                            raise RuntimeError('bridge reported error')
-                        return decoded
-
-            # no frame found, gather data
-            self._received += self.read_raw()
-
-            # discard any data before the first 0
-            first = self._received.find(0)
-            if first < 0:
-                self._received = b''
-            else:
-                self._received = self._received[first:]
-
-    def write_frame(self, frame):
-        self.trace(f'>>> {frame}')
-        self.write_raw(b'\x00' + cobs.cobs.encode(frame) + b'\x00')
-
-    def read_struct(self, fmt):
-        return struct.unpack('<' + fmt, self.read_frame())
-
-    def write_struct(self, fmt, *args):
-        self.write_frame(struct.pack('<' + fmt, *args))
-
-    def call(self, command, r_fmt, w_fmt, *args):
+    # turn a frame into bytes on the wire
+    def _encode_frame(self, frame):
+        if self._debug:
+            self.trace(f'>>> {frame}')
+        return b'\x00' + cobs.cobs.encode(frame) + b'\x00'
+
+    # bytes a frame of size bytes gains on the wire: the delimiters, the
+    # cobs overhead, and with CHECKED, the tag and crc
+    def _framing(self, size):
+        trailer = 3 if self.Mode.CHECKED in self.mode else 0
+        return 2 + (size + trailer) // 254 + 1 + trailer
+
+    # add a tag and crc to a frame with CHECKED, as (tag, frame). the
+    # tag is None without
+    def _trail(self, frame):
+        if self.Mode.CHECKED not in self.mode:
+            return (None, frame)
+        tag = self._tag
+        self._tag = (tag + 1) % 256
+        frame = frame + bytes([tag])
+        return (tag, frame + binascii.crc_hqx(frame, 0).to_bytes(2, 'big'))
+
+    # check a frame that came out of the deframer, and take off any tag
+    # and crc, as (tag, frame). checked defaults to the current mode
+    def _check_frame(self, frame, checked=None):
+        if self._debug:
+            self.trace(f'<<< {frame}')
+        if checked is None:
+            checked = self.Mode.CHECKED in self.mode
+        tag = None
+        if checked:
+            # a crc over a frame and its own crc comes out to 0
+            if len(frame) < 3 or binascii.crc_hqx(frame, 0) != 0:
+                raise _FrameError('bad frame')
+            tag = frame[-3]
+            frame = frame[:-3]
+        if frame and frame[0] == self.Command.ERROR:
+            # error
+            raise RuntimeError('bridge reported error')
+        return (tag, frame)
+
+    # whether a request can be sent again if it or its response goes
+    # missing. FIXED READ and STREAM pop FIFOs. the bridge runs requests
+    # before it checks them, so anything that writes to the bus may have
+    # written somewhere else if its address or length was damaged, and
+    # sending it again would hide that
+    def _resendable(self, command):
+        cval = getattr(command, 'value', command)
+        base = cval & 0x0f
+        if base in (self.Command.STREAM.value, self.Command.COPY.value,
+                    self.Command.POST.value, self.Command.WRITE.value,
+                    self.Command.FILL.value):
+            return False
+        if base == self.Command.READ.value:
+            return not cval & self.Modifier.FIXED.value
+        return True
+
+    # the error for a request that went wrong under CHECKED, but that
+    # _resendable says can not be sent again
+    def _unsent_error(self):
+        return RuntimeError('request or response damaged, and the request '
+                            'may have written memory, so it was not sent '
+                            'again')
+
+    # how many addresses at the start of a response are echoed from the
+    # request. with COMPACT, these are left out
+    def _echoes(self, command):
+        if self.Mode.COMPACT not in self.mode:
+            return 0
+        base = getattr(command, 'value', command) & 0x0f
+        if base == self.Command.COPY.value:
+            return 2
+        if base in (self.Command.PING.value, self.Command.RESET.value,
+                    self.Command.CONFIG.value, self.Command.POST.value):
+            return 0
+        return 1
+
+    # whether a request has a length after its address, which COMPACT
+    # sends 7 bits to a byte
+    def _has_length(self, cval):
+        base = cval & 0x0f
+        if base == self.Command.WRITE.value:
+            return bool(cval & self.Modifier.COUNTED.value)
+        return base in (self.Command.READ.value, self.Command.STREAM.value,
+                        self.Command.POST.value)
+
+    # a length in COMPACT form
+    def _pack_length(self, length):
+        out = bytearray()
+        while length >= 0x80:
+            out.append(0x80 | (length & 0x7f))
+            length >>= 7
+        out.append(length)
+        return bytes(out)
+
+    def _pack_call(self, command, w_fmt, *args):
         cval = getattr(command, 'value', command)
         try:
-            self.write_struct('B' + w_fmt, cval, *args)
-        except struct.error:
+            if self.Mode.COMPACT in self.mode and self._has_length(cval):
+                # w_fmt starts with the address and the length
+                address, length, *rest = args
+                return (_struct('BI').pack(cval, address) +
+                        self._pack_length(length) +
+                        _struct(w_fmt[2:]).pack(*rest))
+            return _struct('B' + w_fmt).pack(cval, *args)
+        except (struct.error, ValueError):
             raise RuntimeError(f'bad arguments to {command}')
+
+    # how long the response to a call is
+    def _response_size(self, command, r_fmt):
+        return _struct('B' + r_fmt[self._echoes(command):]).size
+
+    # args are the request arguments, to fill in anything COMPACT left
+    # out. frames without echoes (like STREAM's) leave it as None
+    def _unpack_call(self, command, r_fmt, frame, args=None):
+        cval = getattr(command, 'value', command)
+        echoes = 0 if args is None else self._echoes(command)
         try:
-            (rcmd, *rest) = self.read_struct('B' + r_fmt)
+            (rcmd, *rest) = _struct('B' + r_fmt[echoes:]).unpack(frame)
         except struct.error:
             raise RuntimeError(f'bad response to {command}')
         if rcmd != cval:
             raise RuntimeError(f'bad response to {command}')
+        if echoes:
+            rest = list(args[:echoes]) + rest
         return rest
 
-    def ping(self):
-        self.call(self.Command.PING, '', '')
-
-    def reset(self, value):
-        value = 1 if value else 0
-        rval, = self.call(self.Command.RESET, 'B', 'B', value)
-        if rval != value:
-            raise RuntimeError(f'bad response to {self.Command.RESET}')
-
-    def read_words(self, address, amount):
-        words = []
-        for chunk in self.read_words_in_chunks(address, amount):
-            words += chunk
-        return words
-
-    def read_words_in_chunks(self, address, amount):
+    def _check_aligned(self, address):
         if not address % self.word_size == 0:
             raise ValueError(f'address must be aligned to {self.word_bits} bits')
 
-        while amount > 0:
-            size = min(amount, self._read_size)
-            size_bytes = size * self.word_size
-            raddr, *chunk = self.call(
-                self.Command.READ, f'I{size}I', 'IB', address, size - 1)
-            if raddr != address or len(chunk) != size:
-                raise RuntimeError(f'bad response to {self.Command.READ}')
-
-            address += size_bytes
-            amount -= size
-            yield chunk
-
-    def read_bytes(self, address, amount):
-        data = b''
-        for chunk in self.read_bytes_in_chunks(address, amount):
-            data += chunk
-        return data
+    # turn little-endian bytes from the bridge into an array of words
+    def _words_array(self, chunks):
+        words = array.array(_array_typecode(self.word_size))
+        for chunk in chunks:
+            words.frombytes(chunk)
+        if sys.byteorder != 'little':
+            words.byteswap()
+        return words
 
-    def read_bytes_in_chunks(self, address, amount):
-        if not address % self.word_size == 0:
-            raise ValueError(f'address must be aligned to {self.word_bits} bits')
-        if not amount % self.word_size == 0:
-            raise ValueError(f'must read a multiple of {self.word_size} bytes')
-        amount = amount // self.word_size
+    # the word-aligned range covering size bytes at address, as
+    # (aligned address, aligned size, offset of address inside it)
+    def _align_range(self, address, size):
+        offset = address % self.word_size
+        aligned_size = -(-(offset + size) // self.word_size) * self.word_size
+        return (address - offset, aligned_size, offset)
 
+    # split amount words at address into (address, size) pieces
+    def _split(self, address, amount, max_size):
         while amount > 0:
-            size = min(amount, self._read_size)
-            size_bytes = size * self.word_size
-            raddr, chunk = self.call(
-                self.Command.READ, f'I{size_bytes}s', 'IB', address, size - 1)
-            if raddr != address or len(chunk) != size_bytes:
-                raise RuntimeError(f'bad response to {self.Command.READ}')
-
-            address += size_bytes
+            size = min(amount, max_size)
+            yield (address, size)
+            address += size * self.word_size
             amount -= size
-            yield chunk
 
-    def read_c_string(self, address, amount=0x1000):
-        data = b''
-        for chunk in self.read_c_string_in_chunks(address, amount=amount):
-            data += chunk
-        return data
-
-    def read_c_string_in_chunks(self, address, amount=0x1000):
-        for chunk in self.read_bytes_in_chunks(address, amount):
-            idx = chunk.find(b'\x00')
-            if idx >= 0:
-                yield chunk[:idx]
-                break
+    # READ calls for amount words at address, as (command, r_fmt, w_fmt,
+    # address, length). with fixed, every word is read from address
+    def _read_calls(self, address, amount, fixed=False):
+        self._check_aligned(address)
+        command = self.Command.READ.value
+        if fixed:
+            command |= self.Modifier.FIXED.value
+
+        for addr, size in self._split(address, amount, self._read_size):
+            if fixed:
+                addr = address
+            # note: length on the wire is size - 1
+            yield (command, f'I{size}I', f'I{self._length_fmt}',
+                   addr, size - 1)
+
+    # WRITE calls for the bytes in data_chunks at address, as (command,
+    # r_fmt, w_fmt, address, ..., data) tuples. partial words at either
+    # end use masked writes if the bridge has them. otherwise the address
+    # must be aligned, and the end is padded with zeros. with posted,
+    # these are POST calls instead, which get no response
+    def _write_calls(self, address, data_chunks, posted=False):
+        masked = self.Mode.MASKED in self.mode
+        if not masked:
+            self._check_aligned(address)
+        address, _, offset = self._align_range(address, 0)
+
+        frame_size = self._write_size * self.word_size
+        lanes = (1 << self.word_size) - 1
+        # data is gathered in here, and copied out whenever it fills
+        staging = bytearray(frame_size)
+        filled = offset
+
+        def call(size, sel_first, sel_last):
+            data = staging[:size]
+            length = size // self.word_size - 1
+            if posted:
+                command = self.Command.POST.value
+                r_fmt = ''
             else:
-                yield chunk
-
-    def write_words(self, address, words):
-        self.write_words_in_chunks(address, [words])
-
-    def write_words_in_chunks(self, address, word_chunks):
-        if not address % self.word_size == 0:
-            raise ValueError(f'address must be aligned to {self.word_bits} bits')
-
-        for words in word_chunks:
-            while words:
-                chunk, words = words[:self._write_size], words[self._write_size:]
-                waddr, amt = self.call(
-                    self.Command.WRITE, 'IB', f'I{len(chunk)}I', address, *chunk)
-                if waddr != address or amt != len(chunk) % 0x100:
-                    raise RuntimeError(f'bad response to {self.Command.WRITE}')
-
-                address += len(chunk) * self.word_size
-
-    def write_bytes(self, address, data):
-        if not len(data) % self.word_size == 0:
-            raise ValueError(f'must write a multiple of {self.word_size} bytes')
-
-        self.write_bytes_in_chunks(address, [data])
-
-    # note: will pad end with zeros to make it work
-    def write_bytes_in_chunks(self, address, data_chunks):
-        if not address % self.word_size == 0:
-            raise ValueError(f'address must be aligned to {self.word_bits} bits')
+                command = self.Command.WRITE.value | self.Modifier.COUNTED.value
+                r_fmt = f'I{self._length_fmt}'
+
+            if sel_first == lanes and sel_last == lanes:
+                if posted:
+                    return (command, r_fmt, f'I{self._length_fmt}{size}s',
+                            address, length, data)
+                return (self.Command.WRITE, r_fmt, f'I{size}s', address, data)
+            command |= self.Modifier.MASKED.value
+            return (command, r_fmt, f'I{self._length_fmt}BB{size}s',
+                    address, length, sel_first, sel_last, data)
+
+        for data in data_chunks:
+            data = memoryview(data).cast('B')
+            while data:
+                amount = min(len(data), frame_size - filled)
+                staging[filled:filled + amount] = data[:amount]
+                data = data[amount:]
+                filled += amount
+
+                if filled == frame_size:
+                    yield call(frame_size, (lanes << offset) & lanes, lanes)
+                    address += frame_size
+                    filled = 0
+                    offset = 0
+
+        if filled > offset:
+            # fill in end with zeros to word_size
+            padded = -(-filled // self.word_size) * self.word_size
+            staging[filled:padded] = bytes(padded - filled)
+            sel_last = lanes
+            if masked:
+                sel_last >>= padded - filled
+            yield call(padded, (lanes << offset) & lanes, sel_last)
+
+    # COPY calls for amount bytes from src to dst. the bridge copies
+    # upwards, so if dst overlaps the end of src, copy pieces no bigger
+    # than the gap, starting from the end
+    def _copy_calls(self, src, dst, amount):
+        self._check_aligned(src)
+        self._check_aligned(dst)
+        if not amount % self.word_size == 0:
+            raise ValueError(f'must copy a multiple of {self.word_size} bytes')
+
+        size = amount
+        if src < dst < src + amount:
+            size = dst - src
+        end = amount
+        while end > 0:
+            start = max(0, end - size)
+            yield (self.Command.COPY, 'II', 'III', src + start, dst + start,
+                   (end - start) // self.word_size - 1)
+            end = start
+
+    # the WAIT call for wait(), as (command, r_fmt, w_fmt, *args)
+    def _wait_call(self, address, pattern, mask, cycles, invert):
+        self._check_aligned(address)
+        if mask is None:
+            mask = (1 << self.word_bits) - 1
+        if cycles is None:
+            cycles = self._wait_budget()
+        command = self.Command.WAIT.value
+        if invert:
+            command |= self.Modifier.INVERT.value
+        return (command, 'IBI', 'IIII', address, cycles, pattern & mask, mask)
+
+    # address of the first of words, read from address, that matches
+    # pattern in every bit set in mask, or None. this is SEARCH, for
+    # bridges without it
+    def _match_words(self, address, words, pattern, mask):
+        for i, word in enumerate(words):
+            if not (word ^ pattern) & mask:
+                return address + i * self.word_size
+        return None
+
+    # how much the next of a run of long commands should do, between
+    # least and most, after the last did amount and took elapsed seconds.
+    # the bridge clock is not known here, so with a timeout, start small
+    # and aim each one at a quarter of it, rather than run into it on
+    # slow clocks
+    def _budget(self, least, most, amount=None, elapsed=None):
+        if self.timeout is None:
+            return most
+        if amount is None:
+            return least
+        target = amount * self.timeout / 4 / max(elapsed, 1e-6)
+        return int(max(least, min(most, 2 * amount, target)))
+
+    # clock cycles for the next WAIT when waiting forever
+    def _wait_budget(self, cycles=None, elapsed=None):
+        return self._budget(self._wait_cycles_min, self._wait_cycles,
+                            cycles, elapsed)
+
+    # words for the next SEARCH, CRC or FILL
+    def _block_budget(self, words=None, elapsed=None):
+        return self._budget(self._block_words_min, self._block_words,
+                            words, elapsed)
+
+    # run call(address, size) over words words at address, in pieces
+    # sized by _block_budget. done(address, size, response) checks each
+    # response, and this returns the first one it is true for, or None
+    def _block_pieces(self, address, words, call, done):
+        size = elapsed = None
+        while words > 0:
+            size = min(words, self._block_budget(size, elapsed))
+            start = time.monotonic()
+            response = yield ('call', *call(address, size))
+            elapsed = time.monotonic() - start
+            if done(address, size, response):
+                return response
+            address += size * self.word_size
+            words -= size
+        return None
+
+    # check the response to a call from _write_calls
+    def _check_write(self, args, response):
+        waddr, *_, chunk = args
+        raddr, amt = response
+        in_words = len(chunk) // self.word_size
+        if raddr != waddr or amt != in_words % self._length_mod:
+            raise RuntimeError(f'bad response to {self.Command.WRITE}')
+
+    # everything below does its i/o through _run(), see _driven
+
+    @_driven
+    def reset(self, value):
+        value = 1 if value else 0
+        rval, = yield ('call', self.Command.RESET, 'B', 'B', value)
+        if rval != value:
+            raise RuntimeError(f'bad response to {self.Command.RESET}')
 
-        data = b''
-        data_chunks = iter(data_chunks)
+    # address of the first word in amount bytes at address that matches
+    # pattern in every bit set in mask, or None
+    @_driven
+    def search(self, address, amount, pattern, mask=None):
+        self._check_aligned(address)
+        if not amount % self.word_size == 0:
+            raise ValueError(f'must search a multiple of {self.word_size} bytes')
+        if mask is None:
+            mask = (1 << self.word_bits) - 1
+        if amount <= 0:
+            return None
+
+        if self.Mode.BLOCK not in self.mode:
+            # no SEARCH, so read it all and look here, a window at a time
+            for addr, size in self._split(address, amount // self.word_size,
+                                          self._read_size * self.window):
+                words = yield ('read_words', addr, size)
+                found = self._match_words(addr, words, pattern, mask)
+                if found is not None:
+                    return found
+            return None
+
+        # the search happens on the device, so this may take a while
+        def call(address, size):
+            return (self.Command.SEARCH, 'IBI', 'IIII',
+                    address, size - 1, pattern, mask)
+
+        def done(address, size, response):
+            raddr, found, _ = response
+            if raddr != address:
+                raise RuntimeError(f'bad response to {self.Command.SEARCH}')
+            return found
+
+        response = yield from self._block_pieces(
+            address, amount // self.word_size, call, done)
+        return response[2] if response else None
+
+    # write word to every word in amount bytes at address, on the bridge.
+    # bridges without FILL are sent every word instead
+    @_driven
+    def fill(self, address, amount, word=0):
+        self._check_aligned(address)
+        if not amount % self.word_size == 0:
+            raise ValueError(f'must fill a multiple of {self.word_size} bytes')
+        if amount <= 0:
+            return
+
+        if self.Mode.BLOCK not in self.mode:
+            for addr, size in self._split(address, amount // self.word_size,
+                                          self._write_size * self.window):
+                yield ('write_words', addr, [word] * size)
+            return
+
+        def call(address, size):
+            return (self.Command.FILL, 'I', 'III', address, size - 1, word)
+
+        def done(address, size, response):
+            if response != [address]:
+                raise RuntimeError(f'bad response to {self.Command.FILL}')
+            return False
+
+        yield from self._block_pieces(
+            address, amount // self.word_size, call, done)
+
+    # wait for the word at address to match pattern in every bit set in
+    # mask (or, with invert, to stop matching) and return it. the bridge
+    # gives up after about cycles clock cycles and this returns None, or
+    # with cycles=None, this waits forever. older bridges without WAIT
+    # are polled from here instead, and cycles only means "try once"
+    @_driven
+    def wait(self, address, pattern, mask=None, cycles=None, invert=False):
+        command, r_fmt, w_fmt, *args = self._wait_call(
+            address, pattern, mask, cycles, invert)
+        _, _, pattern, mask = args
         while True:
-            last = False
-            try:
-                data += bytes(next(data_chunks))
-            except StopIteration:
-                last = True
-                # fill in end with zeros to word_size
-                while len(data) % self.word_size != 0:
-                    data += b'\x00'
-
-            wanted_size = self.word_size * (1 if last else self._write_size)
-            while len(data) >= wanted_size:
-                in_words = min(self._write_size, len(data) // self.word_size)
-                split = in_words * self.word_size
-                chunk, data = data[:split], data[split:]
-                waddr, amt = self.call(
-                    self.Command.WRITE, 'IB', f'I{len(chunk)}s', address, chunk)
-                if waddr != address or amt != in_words % 0x100:
-                    raise RuntimeError(f'bad response to {self.Command.WRITE}')
-
-                address += len(chunk)
-
-            if last:
-                assert len(data) == 0
-                break
+            if self.Mode.WAIT in self.mode:
+                start = time.monotonic()
+                raddr, found, value = yield ('call', command, r_fmt, w_fmt,
+                                             *args)
+                if raddr != address:
+                    raise RuntimeError(f'bad response to {self.Command.WAIT}')
+                if cycles is None:
+                    args[1] = self._wait_budget(
+                        args[1], time.monotonic() - start)
+            else:
+                value, = yield ('read_words', address, 1)
+                found = ((value & mask) == pattern) != invert
+                if not found and cycles is None:
+                    yield ('_sleep', self._wait_delay)
+
+            if found:
+                return value
+            if cycles is not None:
+                return None
 
+    # copy amount bytes from src to dst on the bridge. the ranges may
+    # overlap, like memmove
+    @_driven
+    def copy(self, src, dst, amount):
+        if self.Mode.BLOCK not in self.mode:
+            # no COPY, so bring it all here and back. reading all of it
+            # before writing any takes care of overlaps
+            self._check_aligned(src)
+            if not amount % self.word_size == 0:
+                raise ValueError(f'must copy a multiple of {self.word_size} bytes')
+            words = yield ('read_words', src, amount // self.word_size)
+            yield ('write_words', dst, words)
+            return
+
+        calls = self._copy_calls(src, dst, amount)
+        for (csrc, cdst, _), (rsrc, rdst) in (yield ('_call_many', calls)):
+            if rsrc != csrc or rdst != cdst:
+                raise RuntimeError(f'bad response to {self.Command.COPY}')
+
+    # the RTT control block at address, and every channel in it. on
+    # Bridge, making one reads them all. AsyncBridge can not wait in a
+    # constructor, so there use `await RttControl.load(bridge, address)`
     class RttControl:
         def __init__(self, bridge, address):
+            self._setup(bridge, address)
+            if bridge._blocking:
+                bridge._run(self._load())
+
+        # the same, on either bridge
+        @classmethod
+        def load(cls, bridge, address):
+            return bridge._run(cls._empty(bridge, address)._load())
+
+        # one that has not been read yet, for _load()
+        @classmethod
+        def _empty(cls, bridge, address):
+            control = cls.__new__(cls)
+            control._setup(bridge, address)
+            return control
+
+        def _setup(self, bridge, address):
             self._bridge = bridge
             self._address = address
 
-            after_id = address + 16
-            self._up_size, self._down_size = bridge.read_words(after_id, 2)
+            self._channel_words = 6
+            self._channel_size = self._channel_words * bridge.word_size
+            self._up = address + 16 + 2 * bridge.word_size
+
+            self._ups = []
+            self._downs = []
+
+            self.poller = _Poller()
 
-            self._channel_size = 6 * bridge.word_size;
-            self._up = after_id + 2 * bridge.word_size
+        def _load(self):
+            self._up_size, self._down_size = yield (
+                'read_words', self._address + 16, 2)
             self._down = self._up + self._up_size * self._channel_size
 
+            # read every channel descriptor at once. only the read and
+            # write offsets change after this, so keep the channels around
+            words = yield ('read_words', self._up, self._channel_words *
+                           (self._up_size + self._down_size))
+            split = self._channel_words * self._up_size
+            self._ups = yield from self._load_channels(
+                self._up, words[:split])
+            self._downs = yield from self._load_channels(
+                self._down, words[split:])
+            return self
+
         def __repr__(self):
             meta = ', '.join(f'{k}={v}' for k, v in dict(
                 address = f'0x{self._address:08x}',
@@ -239,47 +994,108 @@ class Bridge:
             ).items())
             return f'{self.__class__.__name__}({meta})'
 
-        def _get_channel(self, base, i, check=True):
-            channel = self._bridge.RttChannel(
-                self._bridge, base + i * self._channel_size)
-            if not channel._buffer_ptr:
-                if check:
-                    raise RuntimeError(f'channel {i} not allocated')
-                return None
+        def _load_channels(self, base, words):
+            channels = []
+            for i in range(0, len(words), self._channel_words):
+                channel = None
+                # skip channels with no buffer
+                if words[i + 1]:
+                    channel = self._bridge.RttChannel._empty(
+                        self._bridge, base + i * self._bridge.word_size)
+                    yield from channel._load(
+                        words[i:i + self._channel_words])
+                channels.append(channel)
+            return channels
+
+        def _get_channel(self, channels, i, check=True):
+            channel = channels[i]
+            if not channel and check:
+                raise RuntimeError(f'channel {i} not allocated')
             return channel
 
         def get_up(self, i):
-            return self._get_channel(self._up, i)
+            return self._get_channel(self._ups, i)
 
         def get_down(self, i):
-            return self._get_channel(self._down, i)
+            return self._get_channel(self._downs, i)
 
         def iter_ups(self):
-            for i in range(self._up_size):
-                channel = self._get_channel(self._up, i)
+            for channel in self._ups:
                 if channel:
                     yield channel
 
         def iter_downs(self):
-            for i in range(self._down_size):
-                channel = self._get_channel(self._down, i)
+            for channel in self._downs:
                 if channel:
                     yield channel
 
+        # refresh the offsets of every up channel in one read, and
+        # return the channels that have data waiting
+        @_driven
+        def poll(self):
+            if not any(self._ups):
+                return []
+
+            # from the first write offset to the last read offset
+            first = self._up + 3 * self._bridge.word_size
+            words = yield ('read_words', first,
+                           self._channel_words * (self._up_size - 1) + 2)
+
+            ready = []
+            available = 0
+            for i, channel in enumerate(self._ups):
+                if channel:
+                    offset = i * self._channel_words
+                    channel._write, channel._read = words[offset:offset + 2]
+                    amount = channel._available()
+                    if amount:
+                        ready.append(channel)
+                        available += amount
+            self.poller.record(available)
+            return ready
+
+        # wait as long as the poller says before the next poll()
+        @_driven
+        def wait(self):
+            if self.poller.delay:
+                yield ('_sleep', self.poller.delay)
+
+    # the RTT channel descriptor at address, read unless words has it.
+    # like RttControl, use `await RttChannel.load(...)` on AsyncBridge
     class RttChannel:
         _MODE_SKIP  = 0x0
         _MODE_TRIM  = 0x1
         _MODE_BLOCK = 0x2
         _MODE_MASK  = 0x3
 
-        def __init__(self, bridge, address):
+        def __init__(self, bridge, address, words=None):
+            self._setup(bridge, address)
+            if bridge._blocking:
+                bridge._run(self._load(words))
+
+        @classmethod
+        def load(cls, bridge, address, words=None):
+            return bridge._run(cls._empty(bridge, address)._load(words))
+
+        @classmethod
+        def _empty(cls, bridge, address):
+            channel = cls.__new__(cls)
+            channel._setup(bridge, address)
+            return channel
+
+        def _setup(self, bridge, address):
             self._bridge = bridge
             self._address = address
-
             self._write_addr = address + 3 * bridge.word_size
             self._read_addr = address + 4 * bridge.word_size
+            self.poller = _Poller()
+            self.name = None
 
-            self._update(fast=False)
+        def _load(self, words=None):
+            if words is None:
+                words = yield ('read_words', self._address, 6)
+            yield from self._set(words)
+            return self
 
         def __repr__(self):
             meta = ', '.join(f'{k}={v}' for k, v in dict(
@@ -287,8 +1103,7 @@ class Bridge:
             ).items())
             return f'{self.__class__.__name__}({meta})'
 
-        def _update(self, fast=True):
-            words = self._bridge.read_words(self._address, 6)
+        def _set(self, words):
             self._name_ptr = words[0]
             self._buffer_ptr = words[1]
             self._size = words[2]
@@ -296,15 +1111,36 @@ class Bridge:
             self._read = words[4]
             self._flags = words[5]
 
-            if not fast:
-                if self._name_ptr:
-                    self.name = self._bridge.read_c_string(self._name_ptr)
-                else:
-                    self.name = None
+            if self._name_ptr:
+                self.name = yield ('read_c_string', self._name_ptr)
+            else:
+                self.name = None
 
-        def _read_buffer(self):
+        def _update(self, fast=True):
+            if fast:
+                # only the offsets change once the channel is set up
+                self._write, self._read = yield (
+                    'read_words', self._write_addr, 2)
+            else:
+                yield from self._set(
+                    (yield ('read_words', self._address, 6)))
+
+        # read size bytes of the buffer at offset, which must not wrap
+        def _read_span(self, offset, size):
             assert self._buffer_ptr
-            return self._bridge.read_bytes(self._buffer_ptr, self._size)
+            address, aligned_size, skip = self._bridge._align_range(
+                self._buffer_ptr + offset, size)
+            data = yield ('read_bytes', address, aligned_size)
+            return data[skip:skip + size]
+
+        # read amount bytes from the read offset on. this only fetches the
+        # bytes asked for, in two pieces if they wrap around the end
+        def _read_ring(self, amount):
+            first = min(amount, self._size - self._read)
+            data = yield from self._read_span(self._read, first)
+            if amount > first:
+                data += yield from self._read_span(0, amount - first)
+            return data
 
         def _write_buffer(self, buf):
             assert self._buffer_ptr
@@ -316,108 +1152,933 @@ class Bridge:
                 amt += self._size
             return amt
 
+        # bytes waiting as of the last update
+        def _available(self):
+            return self._wrap_amount(self._write - self._read)
+
+        @_driven
         def get_data(self, update=True):
             if update:
-                self._update()
-            return self._wrap_amount(self._write - self._read)
+                yield from self._update()
+            return self._available()
 
+        @_driven
         def get_space(self, update=True):
             if update:
-                self._update()
+                yield from self._update()
             return self._wrap_amount(self._read - self._write - 1)
 
+        @_driven
         def getchar(self, wait=True):
-            self._update()
-            if wait:
-                # wait until available
-                while self._read == self._write:
-                    time.sleep(0.01)
-                    self._update()
-
-            if self._read == self._write:
-                return None
+            data = yield from self._read_available(1, wait, True)
+            return data if data else None
+
+        # read up to amount bytes (or everything available). if wait is
+        # set, keep waiting until all amount bytes have arrived, which is
+        # the default when amount is given
+        @_driven
+        def read(self, amount=None, wait=None, update=True):
+            if wait is None:
+                wait = amount is not None
+            return (yield from self._read_available(amount, wait, update))
+
+        def _read_available(self, amount, wait, update):
+            if update:
+                yield from self._update()
+            if amount is None:
+                amount = self._available()
+
+            data = bytearray()
+            while len(data) < amount:
+                amount_now = min(amount - len(data), self._available())
+                self.poller.record(amount_now)
+                if amount_now:
+                    data += yield from self._read_ring(amount_now)
+                    self._read = (self._read + amount_now) % self._size
+                    yield ('write_words', self._read_addr, [self._read])
+                elif not wait:
+                    break
+                else:
+                    # wait for more, on the bridge if it can
+                    self._write = yield ('wait', self._write_addr,
+                                         self._write, None, None, True)
+
+            return bytes(data)
+
+    # search each (start, end) range for the RTT magic. the device only
+    # matches single words, so check the rest of the magic here. bridges
+    # without SEARCH send all of it, a window at a time, to look through
+    # here instead
+    def _scan_rtt(self, ranges):
+        first = int.from_bytes(_RTT_MAGIC[:self.word_size], 'little')
+        for start, end in ranges:
+            address, size, _ = self._align_range(start, end - start)
+            end = address + size
+            if self.Mode.BLOCK not in self.mode:
+                tail = b''
+                piece = self._read_size * self.window * self.word_size
+                while address < end:
+                    chunk = yield ('read_bytes', address,
+                                   min(piece, end - address))
+                    found, tail = _find_rtt_magic(address, tail, chunk)
+                    if found is not None:
+                        return found
+                    address += len(chunk)
+                continue
+            while address < end:
+                address = yield ('search', address, end - address, first)
+                if address is None:
+                    break
+                if (yield from self._check_rtt(address)):
+                    return address
+                address += self.word_size
+        return None
+
+    def _check_rtt(self, address):
+        start, size, skip = self._align_range(address, len(_RTT_MAGIC))
+        data = yield ('read_bytes', start, size)
+        return data[skip:skip + len(_RTT_MAGIC)] == _RTT_MAGIC
+
+    # the firmware writes the magic when it starts, which may not have
+    # happened yet, so keep checking for up to self._rtt_timeout seconds
+    def _wait_rtt(self, address):
+        deadline = time.monotonic() + self._rtt_timeout
+        while not (yield from self._check_rtt(address)):
+            if time.monotonic() >= deadline:
+                return False
+            yield ('_sleep', self._wait_delay)
+        return True
+
+    def _find_rtt_in_elf(self, elf, symbol, cache):
+        digest = _elf_digest(elf)
+        if cache:
+            address = cache.get(digest)
+            if address is not None and (yield from self._check_rtt(address)):
+                return address
+
+        # the symbol is only trusted once the magic is there. if it never
+        # shows up, the device may be running some other build
+        address = _elf_symbol(elf, symbol)
+        if address is not None and not (yield from self._wait_rtt(address)):
+            address = None
+        if address is None:
+            address = yield from self._scan_rtt(_elf_writable_ranges(elf))
+        if address is not None and cache:
+            cache.set(digest, address)
+        return address
+
+    # find the RTT control block. with an ELF, use symbol or its cached
+    # address, falling back to scanning its writable segments. without
+    # one, scan from start to end
+    @_driven
+    def find_rtt(self, address=None, start=0, end=1 << 32, elf=None,
+                 symbol='_SEGGER_RTT', cache=True):
+        if cache is True:
+            cache = _RttCache()
+
+        if address is None and elf is not None:
+            address = yield from self._find_rtt_in_elf(elf, symbol, cache)
+        elif address is None:
+            address = yield from self._scan_rtt([(start, end)])
+        if address is None:
+            raise RuntimeError('could not find RTT block')
 
-            c = self._read_buffer()[self._read:self._read + 1]
-            self._read = (self._read + 1) % self._size
-            self._bridge.write_words(self._read_addr, [self._read])
+        return (yield from self.RttControl._empty(self, address)._load())
 
-            return c
+class Bridge(_BridgeBase):
+    def close(self):
+        raise NotImplementedError
 
-        def read(self, amount=None):
-            self._update()
-            available = self.get_data(False)
+    # block until some data arrives, or until timeout seconds pass
+    # (returning b'' in that case). timeout=None waits forever.
+    def read_raw(self, timeout=None):
+        raise NotImplementedError
 
-            if amount is None:
-                amount = available
+    def write_raw(self, data):
+        raise NotImplementedError
 
-            data = b''
-            while len(data) < amount:
-                available = self.get_data(False)
-                buf = self._read_buffer()
-                amount_now = available if amount > available else amount
-                data += (buf + buf)[self._read:self._read + amount_now]
-                self._read = (self._read + amount_now) % self._size
-                self._bridge.write_words(self._read_addr, [self._read])
+    def __enter__(self):
+        return self
 
-                if len(data) >= amount:
-                    return data
+    def __exit__(self, typ, value, traceback):
+        self.close()
 
-                time.sleep(0.01)
-                self._update()
+    def read_frame(self):
+        return self._check_frame(self._read_frame())[1]
+
+    # read a frame as it came in, without checking it
+    def _read_frame(self):
+        deadline = None
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+
+        frame = self._deframer.pop()
+        while frame is None:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError('timed out waiting for bridge')
+
+            data = self.read_raw(timeout=remaining)
+            if data and deadline is not None:
+                deadline = time.monotonic() + self.timeout
+            self._deframer.feed(data)
+            frame = self._deframer.pop()
+
+        return frame
 
-    def find_rtt(self, address=None, start=0, end=1 << 32):
-        if address is None:
-            magic = b'SEGGER RTT\0\0\0\0\0\0'
-            chunk_end = b''
-            address = start
-            for chunk in self.read_bytes_in_chunks(start, end - start):
-                chunk = chunk_end + chunk
-                idx = chunk.find(magic)
-                if idx >= 0:
-                    address += idx
+    def write_frame(self, frame):
+        self.write_raw(self._encode_frame(frame))
+
+    def read_struct(self, fmt):
+        return _struct(fmt).unpack(self.read_frame())
+
+    def write_struct(self, fmt, *args):
+        self.write_frame(_struct(fmt).pack(*args))
+
+    # send a call without waiting for a response
+    def _call_send(self, command, w_fmt, *args):
+        self.write_frame(self._trail(self._pack_call(command, w_fmt, *args))[1])
+
+    def call(self, command, r_fmt, w_fmt, *args):
+        for _, response in self.call_pipelined([(command, r_fmt, w_fmt, *args)]):
+            return response
+
+    # calls is an iterable of (command, r_fmt, w_fmt, *args) tuples.
+    # yields (args, response) in order, keeping up to self.window
+    # requests in flight at once
+    def call_pipelined(self, calls):
+        frames = ((self._pack_call(command, w_fmt, *args), (command, r_fmt, args))
+                  for command, r_fmt, w_fmt, *args in calls)
+        frames = self._frames_pipelined(
+            frames, lambda key: self._resendable(key[0]))
+        for (command, r_fmt, args), frame in frames:
+            yield (args, self._unpack_call(command, r_fmt, frame, args))
+
+    # frames is an iterable of (frame, key) pairs. yields (key, response
+    # frame) in order, keeping up to self.window frames in flight at once.
+    #
+    # with CHECKED, each response has the tag of its request. the bridge
+    # answers in order, so a response to a later request means the ones
+    # before it were lost. frames that resend(key) allows are sent again
+    # when their response is damaged or lost (or times out), up to
+    # self.retries times
+    def _frames_pipelined(self, frames, resend=lambda key: False):
+        # (order sent, tag, frame, key, tries) in flight
+        pending = collections.deque()
+        # responses that came in before the ones ahead of them, by tag
+        early = {}
+        sent = itertools.count()
+
+        def send(frame, key, tries=0):
+            tag, trailed = self._trail(frame)
+            self.write_frame(trailed)
+            return (next(sent), tag, frame, key, tries)
+
+        def response(order, tag):
+            if tag is None:
+                return self.read_frame()
+            while tag not in early:
+                rtag, frame = self._check_frame(self._read_frame())
+                if rtag == tag:
+                    return frame
+                for other in pending:
+                    if other[1] == rtag:
+                        early[rtag] = frame
+                        if other[0] > order:
+                            raise _FrameError('lost response')
+                        break
+                # otherwise, it is for a request already sent again
+            return early.pop(tag)
+
+        def receive():
+            while True:
+                order, tag, frame, key, tries = pending.popleft()
+                try:
+                    return (key, response(order, tag))
+                except (_FrameError, TimeoutError) as e:
+                    if tag is None or tries >= self.retries:
+                        raise
+                    if not resend(key):
+                        raise self._unsent_error() from e
+                    self.trace(f'sending again: {frame}')
+                    pending.appendleft(send(frame, key, tries + 1))
+
+        try:
+            for frame, key in frames:
+                if len(pending) >= self.window:
+                    yield receive()
+                pending.append(send(frame, key))
+            while pending:
+                yield receive()
+        finally:
+            # if we stopped early, eat responses still in flight
+            for _ in range(len(pending) - len(early)):
+                try:
+                    self.read_frame()
+                except RuntimeError:
+                    pass
+                except TimeoutError:
                     break
-                address += len(chunk[:-len(magic)])
-                chunk_end = chunk[-len(magic):]
+
+    # queue up reads and writes, and send them all when the block ends:
+    #
+    #     with bridge.batch() as batch:
+    #         a = batch.read_words(0x100, 1)
+    #         batch.write_words(0x200, [1, 2])
+    #     print(a.result())
+    @contextlib.contextmanager
+    def batch(self):
+        batch = self.Batch(self)
+        yield batch
+        self.flush_batch(batch)
+
+    def flush_batch(self, batch):
+        # batches are only sent again if everything in them can be
+        resend = lambda calls: all(self._resendable(call[0]) for call in calls)
+        for group in batch._groups():
+            for calls, frame in self._frames_pipelined(group, resend):
+                batch._finish(calls, frame)
+        batch._done()
+
+    # operations run to the end in _run(), so they return their results
+    _blocking = True
+
+    # run an operation from _BridgeBase, see _driven
+    def _run(self, op):
+        result = None
+        while True:
+            try:
+                name, *args = op.send(result)
+            except StopIteration as stop:
+                return stop.value
+            result = getattr(self, name)(*args)
+
+    def _sleep(self, seconds):
+        time.sleep(seconds)
+
+    def _call_many(self, calls):
+        return list(self.call_pipelined(calls))
+
+    def ping(self):
+        self.write_frame(self._pack_ping())
+        self._unpack_ping(self._read_frame())
+
+    # PING, to wait for everything sent before it to finish. anything
+    # that answered with an error on the way is raised here
+    def _confirm(self):
+        self.write_frame(self._pack_ping())
+        error = None
+        while True:
+            try:
+                frame = self._read_frame()
+            except _FrameError as e:
+                error = e
+                continue
+            if frame[:1] == bytes([self.Command.PING.value]):
+                break
+            try:
+                self._check_frame(frame)
+            except RuntimeError as e:
+                error = e
+        self._unpack_ping(frame)
+        if error is not None:
+            raise error
+
+    # with fixed, read every word from address, like a FIFO
+    def read_words(self, address, amount, fixed=False):
+        words = []
+        for chunk in self.read_words_in_chunks(address, amount, fixed=fixed):
+            words += chunk
+        return words
+
+    # like read_words, but returns an array.array of words. this avoids
+    # creating a python int for every word, and numpy.frombuffer() can
+    # use the result without copying it
+    def read_words_array(self, address, amount):
+        return self._words_array(
+            self.read_bytes_in_chunks(address, amount * self.word_size))
+
+    def read_words_in_chunks(self, address, amount, fixed=False):
+        calls = self._read_calls(address, amount, fixed=fixed)
+        for (addr, length), (raddr, *chunk) in self.call_pipelined(calls):
+            if raddr != addr or len(chunk) != length + 1:
+                raise RuntimeError(f'bad response to {self.Command.READ}')
+            yield chunk
+
+    # yield words read from address over and over (or with fixed=False,
+    # from one address after the next) until this generator is closed.
+    # the bridge sends size words to a frame without being asked again,
+    # so a few frames already read from a FIFO are lost when it stops
+    def stream_words(self, address, size=256, fixed=True):
+        self._check_aligned(address)
+        if not 0 < size <= self._read_size:
+            raise ValueError(f'size must be between 1 and {self._read_size}')
+        command = self.Command.STREAM.value
+        if fixed:
+            command |= self.Modifier.FIXED.value
+
+        raddr, = self.call(command, 'I', f'I{self._length_fmt}',
+                           address, size - 1)
+        if raddr != address:
+            raise RuntimeError(f'bad response to {self.Command.STREAM}')
+
+        try:
+            while True:
+                yield from self._unpack_call(command, f'{size}I',
+                                             self.read_frame())
+        finally:
+            # any frame stops the stream. PING answers with something
+            # easy to tell apart from the STREAM frames still coming
+            self.write_frame(self._pack_ping())
+            frame = self._read_frame()
+            while frame[:1] == bytes([command]):
+                frame = self._read_frame()
+            self._unpack_ping(frame)
+
+    # the chunks are bytes already, so joining them is the only copy. to
+    # read into a buffer of your own, use read_bytes_into
+    def read_bytes(self, address, amount):
+        return b''.join(self.read_bytes_in_chunks(address, amount))
+
+    # read len(buffer) bytes at address straight into buffer, which can be
+    # anything that supports the buffer protocol: a bytearray, an mmap...
+    def read_bytes_into(self, address, buffer):
+        view = memoryview(buffer).cast('B')
+        offset = 0
+        for chunk in self.read_bytes_in_chunks(address, len(view)):
+            view[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+
+    def read_bytes_in_chunks(self, address, amount):
+        self._check_aligned(address)
+        if not amount % self.word_size == 0:
+            raise ValueError(f'must read a multiple of {self.word_size} bytes')
+        amount = amount // self.word_size
+
+        calls = ((self.Command.READ, f'I{size * self.word_size}s',
+                  f'I{self._length_fmt}',
+                  addr, size - 1)
+                 for addr, size in self._split(address, amount, self._read_size))
+        # note: length on the wire is size - 1
+        for (addr, length), (raddr, chunk) in self.call_pipelined(calls):
+            if raddr != addr or len(chunk) != (length + 1) * self.word_size:
+                raise RuntimeError(f'bad response to {self.Command.READ}')
+            yield chunk
+
+    def read_c_string(self, address, amount=0x1000):
+        data = bytearray()
+        for chunk in self.read_c_string_in_chunks(address, amount=amount):
+            data += chunk
+        return bytes(data)
+
+    def read_c_string_in_chunks(self, address, amount=0x1000):
+        for chunk in self.read_bytes_in_chunks(address, amount):
+            idx = chunk.find(b'\x00')
+            if idx >= 0:
+                yield chunk[:idx]
+                break
             else:
-                raise RuntimeError('could not find RTT block')
+                yield chunk
+
+    def write_words(self, address, words):
+        self.write_words_in_chunks(address, [words])
+
+    def write_words_in_chunks(self, address, word_chunks):
+        self._check_aligned(address)
+
+        def calls():
+            nonlocal address
+            # frames may span word_chunks, take whole frames at a time
+            words = itertools.chain.from_iterable(word_chunks)
+            while True:
+                chunk = tuple(itertools.islice(words, self._write_size))
+                if not chunk:
+                    break
+                yield (self.Command.WRITE, f'I{self._length_fmt}',
+                       f'I{len(chunk)}I', address, *chunk)
+                address += len(chunk) * self.word_size
 
-        return self.RttControl(self, address)
+        for (waddr, *chunk), (raddr, amt) in self.call_pipelined(calls()):
+            if raddr != waddr or amt != len(chunk) % self._length_mod:
+                raise RuntimeError(f'bad response to {self.Command.WRITE}')
+
+    # writes any range of bytes if the bridge has masked writes, or else
+    # only whole words
+    def write_bytes(self, address, data, posted=False):
+        if self.Mode.MASKED not in self.mode:
+            if not len(data) % self.word_size == 0:
+                raise ValueError(f'must write a multiple of {self.word_size} bytes')
+
+        self.write_bytes_in_chunks(address, [data], posted=posted)
+
+    # note: without masked writes, will pad end with zeros to make it work.
+    # with posted, the bridge does not answer each write, and this only
+    # waits for one PING at the end. bridges without POST ignore posted
+    def write_bytes_in_chunks(self, address, data_chunks, posted=False):
+        if posted and self.Mode.POST in self.mode:
+            for command, _, w_fmt, *args in self._write_calls(
+                    address, data_chunks, posted=True):
+                self._call_send(command, w_fmt, *args)
+            self._confirm()
+            return
+
+        calls = self._write_calls(address, data_chunks)
+        for args, response in self.call_pipelined(calls):
+            self._check_write(args, response)
+
+    # crc32 (as in zlib.crc32) of amount bytes at address, computed on
+    # the bridge so the data itself never crosses the link
+    def crc32(self, address, amount):
+        chunk_size = max(amount, self.word_size)
+        for crc in self.crc32_in_chunks(address, amount, chunk_size):
+            return crc
+        return zlib.crc32(b'')
+
+    # crc32 of every chunk_size bytes at address
+    def crc32_in_chunks(self, address, amount, chunk_size):
+        self._check_aligned(address)
+        if not amount % self.word_size == 0:
+            raise ValueError(f'must check a multiple of {self.word_size} bytes')
+        if not chunk_size % self.word_size == 0 or chunk_size <= 0:
+            raise ValueError(f'chunks must be a multiple of {self.word_size} bytes')
+
+        if self.Mode.BLOCK not in self.mode:
+            # no CRC, so read it all and check it here
+            crc = zlib.crc32(b'')
+            done = 0
+            for data in self.read_bytes_in_chunks(address, amount):
+                while data:
+                    size = min(len(data), chunk_size - done)
+                    crc = zlib.crc32(data[:size], crc)
+                    data = data[size:]
+                    done += size
+                    if done == chunk_size:
+                        yield crc
+                        crc = zlib.crc32(b'')
+                        done = 0
+            if done:
+                yield crc
+            return
+
+        chunks = self._split(address, amount // self.word_size,
+                             chunk_size // self.word_size)
+        if chunk_size // self.word_size > self._block_budget():
+            # chunks this long might run into the timeout, so each is
+            # done in pieces, and their crcs put together here
+            for addr, size in chunks:
+                yield self._run(self._crc32_pieces(addr, size))
+            return
+
+        calls = ((self.Command.CRC, 'II', 'II', addr, size - 1)
+                 for addr, size in chunks)
+        for (addr, _), (raddr, crc) in self.call_pipelined(calls):
+            if raddr != addr:
+                raise RuntimeError(f'bad response to {self.Command.CRC}')
+            yield crc
+
+    def _crc32_pieces(self, address, words):
+        crc = zlib.crc32(b'')
+
+        def call(address, size):
+            return (self.Command.CRC, 'II', 'II', address, size - 1)
+
+        def done(address, size, response):
+            nonlocal crc
+            raddr, piece = response
+            if raddr != address:
+                raise RuntimeError(f'bad response to {self.Command.CRC}')
+            crc = _crc32_combine(crc, piece, size * self.word_size)
+            return False
+
+        yield from self._block_pieces(address, words, call, done)
+        return crc
 
 class SerialBridge(Bridge):
-    def __init__(self, port, baud=1_000_000, debug=False):
-        self._port = serial.Serial(port, baud, timeout=0)
-        super().__init__(debug=debug)
+    # seconds each read blocks on the port at most. changing the port
+    # timeout reconfigures the port, so it stays at this, and read_raw
+    # keeps reading until its own timeout is up
+    _port_timeout = 0.05
+
+    def __init__(self, port, baud=1_000_000, **kwargs):
+        self._port = serial.Serial(port, baud, timeout=self._port_timeout)
+        super().__init__(**kwargs)
 
     def close(self):
         self._port.close()
 
-    def read_raw(self):
-        data = self._port.read(256)
-        # anti busy-loop
-        if len(data) == 0:
-            time.sleep(0.01)
-        return data
+    def read_raw(self, timeout=None):
+        deadline = None
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+
+        # block for the first byte, then take whatever else is waiting
+        while True:
+            data = self._port.read(1)
+            if data:
+                return data + self._port.read(self._port.in_waiting)
+            if deadline is not None and time.monotonic() >= deadline:
+                return b''
 
     def write_raw(self, data):
         self._port.write(data)
 
 class ProcessBridge(Bridge):
-    def __init__(self, args, debug=False):
+    def __init__(self, args, **kwargs):
         self._proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        super().__init__(debug=debug)
+
+        # read stdout directly, without blocking, whenever it is ready
+        self._stdout = self._proc.stdout.fileno()
+        os.set_blocking(self._stdout, False)
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._stdout, selectors.EVENT_READ)
+
+        super().__init__(**kwargs)
 
     def close(self):
+        self._selector.close()
         self._proc.terminate()
         self._proc.wait()
 
-    def read_raw(self):
-        # FIXME more efficient reads, maybe
-        return self._proc.stdout.read(1)
+    def read_raw(self, timeout=None):
+        # wait for output, then take all of it at once
+        if not self._selector.select(timeout):
+            return b''
+        try:
+            data = os.read(self._stdout, 0x10000)
+        except BlockingIOError:
+            return b''
+        if not data:
+            raise RuntimeError('bridge process exited')
+        return data
 
     def write_raw(self, data):
         self._proc.stdin.write(data)
         self._proc.stdin.flush()
 
+class AsyncBridge(_BridgeBase):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # (tag, future) waiting on responses, in the order requests were
+        # sent. the tag is None for frames without one
+        self._pending = collections.deque()
+        self._slots = asyncio.Semaphore(self.window)
+        # when data last arrived, for the timeout
+        self._received = time.monotonic()
+
+    async def open(self):
+        raise NotImplementedError
+
+    async def close(self):
+        raise NotImplementedError
+
+    def write_raw(self, data):
+        raise NotImplementedError
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, typ, value, traceback):
+        await self.close()
+
+    # called by subclasses when data arrives
+    def _data_received(self, data):
+        self._received = time.monotonic()
+        self._deframer.feed(data)
+        while True:
+            try:
+                frame = self._deframer.pop()
+            except _FrameError as e:
+                # no telling who this was for, so it goes to the next one
+                frame = e
+            if frame is None:
+                break
+            self._frame_received(frame)
+
+    # with CHECKED, a frame that checks out has the tag of the request it
+    # answers. the bridge answers in order, so requests sent before that
+    # one lost their responses. everything else goes to the next request
+    def _frame_received(self, frame):
+        tag = None
+        if (self.Mode.CHECKED in self.mode and isinstance(frame, bytes) and
+                len(frame) >= 3 and binascii.crc_hqx(frame, 0) == 0):
+            tag = frame[-3]
+            if not any(ptag == tag for ptag, _ in self._pending):
+                self.trace(f'unexpected frame {frame}')
+                return
+
+        while self._pending:
+            ptag, future = self._pending.popleft()
+            if tag is not None and ptag is not None and ptag != tag:
+                if not future.done():
+                    future.set_exception(_FrameError('lost response'))
+                continue
+            # skip requests that were cancelled or timed out
+            if not future.done():
+                if isinstance(frame, Exception):
+                    future.set_exception(frame)
+                else:
+                    future.set_result(frame)
+            return
+        self.trace(f'unexpected frame {frame}')
+
+    # called by subclasses when the connection goes away
+    def _connection_lost(self, exc):
+        while self._pending:
+            _, future = self._pending.popleft()
+            if not future.done():
+                future.set_exception(RuntimeError('bridge connection lost'))
+
+    # many calls may be in flight at once, from any number of tasks.
+    # at most self.window are sent to the bridge at a time.
+    async def call(self, command, r_fmt, w_fmt, *args):
+        frame = self._pack_call(command, w_fmt, *args)
+        response = await self._call_frame(frame, self._resendable(command))
+        return self._unpack_call(command, r_fmt, response, args)
+
+    # send a frame as it is, and return the response frame as it came in
+    async def _exchange(self, frame, tag=None):
+        async with self._slots:
+            future = asyncio.get_running_loop().create_future()
+            self.write_raw(self._encode_frame(frame))
+            self._pending.append((tag, future))
+            if self.timeout is None:
+                return await future
+
+            # like Bridge, the timeout counts from the last data to arrive
+            deadline = time.monotonic() + self.timeout
+            try:
+                while True:
+                    try:
+                        return await asyncio.wait_for(
+                            asyncio.shield(future),
+                            deadline - time.monotonic())
+                    except asyncio.TimeoutError:
+                        deadline = self._received + self.timeout
+                        if deadline <= time.monotonic():
+                            raise
+            finally:
+                # if nobody is waiting on it, its response is dropped
+                future.cancel()
+
+    # send a frame, and return the response frame. with CHECKED and
+    # resend, it is sent again when the response is damaged or lost (or
+    # times out), up to self.retries times
+    async def _call_frame(self, frame, resend=False):
+        for tries in itertools.count():
+            tag, trailed = self._trail(frame)
+            try:
+                return self._check_frame(await self._exchange(trailed, tag))[1]
+            except (_FrameError, asyncio.TimeoutError) as e:
+                if tag is None or tries >= self.retries:
+                    raise
+                if not resend:
+                    raise self._unsent_error() from e
+                self.trace(f'sending again: {frame}')
+
+    # calls is an iterable of (command, r_fmt, w_fmt, *args) tuples.
+    # yields (args, response) in order, keeping up to self.window
+    # requests in flight at once
+    async def call_pipelined(self, calls):
+        pending = collections.deque()
+        try:
+            for command, r_fmt, w_fmt, *args in calls:
+                if len(pending) >= self.window:
+                    args_done, task = pending.popleft()
+                    yield (args_done, await task)
+                pending.append((args, asyncio.ensure_future(
+                    self.call(command, r_fmt, w_fmt, *args))))
+            while pending:
+                args_done, task = pending.popleft()
+                yield (args_done, await task)
+        finally:
+            # responses to these are dropped when they arrive
+            for _, task in pending:
+                task.cancel()
+
+    @contextlib.asynccontextmanager
+    async def batch(self):
+        batch = self.Batch(self)
+        yield batch
+        await self.flush_batch(batch)
+
+    async def flush_batch(self, batch):
+        for group in batch._groups():
+            # the slots keep these in order, and at most self.window in flight
+            # batches are only sent again if everything in them can be
+            responses = await asyncio.gather(
+                *(self._call_frame(frame, all(self._resendable(call[0])
+                                              for call in calls))
+                  for frame, calls in group))
+            for (_, calls), response in zip(group, responses):
+                batch._finish(calls, response)
+        batch._done()
+
+    # operations return coroutines from _run(), to be awaited
+    _blocking = False
+
+    # run an operation from _BridgeBase, see _driven
+    async def _run(self, op):
+        result = None
+        while True:
+            try:
+                name, *args = op.send(result)
+            except StopIteration as stop:
+                return stop.value
+            result = await getattr(self, name)(*args)
+
+    async def _sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+    async def _call_many(self, calls):
+        return [r async for r in self.call_pipelined(calls)]
+
+    async def ping(self):
+        self._unpack_ping(await self._exchange(self._pack_ping()))
+
+    async def read_words(self, address, amount, fixed=False):
+        words = []
+        async for chunk in self.read_words_in_chunks(address, amount,
+                                                     fixed=fixed):
+            words += chunk
+        return words
+
+    async def read_words_array(self, address, amount):
+        chunks = self.read_bytes_in_chunks(address, amount * self.word_size)
+        return self._words_array([chunk async for chunk in chunks])
+
+    async def read_words_in_chunks(self, address, amount, fixed=False):
+        calls = self._read_calls(address, amount, fixed=fixed)
+        async for (addr, length), (raddr, *chunk) in self.call_pipelined(calls):
+            if raddr != addr or len(chunk) != length + 1:
+                raise RuntimeError(f'bad response to {self.Command.READ}')
+            yield chunk
+
+    async def read_bytes(self, address, amount):
+        chunks = self.read_bytes_in_chunks(address, amount)
+        return b''.join([chunk async for chunk in chunks])
+
+    async def read_bytes_into(self, address, buffer):
+        view = memoryview(buffer).cast('B')
+        offset = 0
+        async for chunk in self.read_bytes_in_chunks(address, len(view)):
+            view[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+
+    async def read_bytes_in_chunks(self, address, amount):
+        self._check_aligned(address)
+        if not amount % self.word_size == 0:
+            raise ValueError(f'must read a multiple of {self.word_size} bytes')
+        amount = amount // self.word_size
+
+        calls = ((self.Command.READ, f'I{size * self.word_size}s',
+                  f'I{self._length_fmt}',
+                  addr, size - 1)
+                 for addr, size in self._split(address, amount, self._read_size))
+        # note: length on the wire is size - 1
+        async for (addr, length), (raddr, chunk) in self.call_pipelined(calls):
+            if raddr != addr or len(chunk) != (length + 1) * self.word_size:
+                raise RuntimeError(f'bad response to {self.Command.READ}')
+            yield chunk
+
+    async def read_c_string(self, address, amount=0x1000):
+        data = bytearray()
+        async for chunk in self.read_bytes_in_chunks(address, amount):
+            idx = chunk.find(b'\x00')
+            if idx >= 0:
+                data += chunk[:idx]
+                break
+            data += chunk
+        return bytes(data)
+
+    async def write_words(self, address, words):
+        self._check_aligned(address)
+
+        def calls():
+            for addr, size in self._split(address, len(words), self._write_size):
+                start = (addr - address) // self.word_size
+                yield (self.Command.WRITE, f'I{self._length_fmt}',
+                       f'I{size}I', addr, *words[start:start + size])
+
+        async for (waddr, *chunk), (raddr, amt) in self.call_pipelined(calls()):
+            if raddr != waddr or amt != len(chunk) % self._length_mod:
+                raise RuntimeError(f'bad response to {self.Command.WRITE}')
+
+    async def write_bytes(self, address, data):
+        if self.Mode.MASKED not in self.mode:
+            if not len(data) % self.word_size == 0:
+                raise ValueError(f'must write a multiple of {self.word_size} bytes')
+
+        calls = self._write_calls(address, [data])
+        async for args, response in self.call_pipelined(calls):
+            self._check_write(args, response)
+
+class _AsyncBridgeProtocol(asyncio.Protocol):
+    def __init__(self, bridge):
+        self._bridge = bridge
+
+    def data_received(self, data):
+        self._bridge._data_received(data)
+
+    def connection_lost(self, exc):
+        self._bridge._connection_lost(exc)
+
+class AsyncSerialBridge(AsyncBridge):
+    def __init__(self, port, baud=1_000_000, **kwargs):
+        self._port = serial.Serial(port, baud, timeout=0)
+        super().__init__(**kwargs)
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        # the read transport owns the port, the write transport a copy of it
+        self._reader, _ = await loop.connect_read_pipe(
+            lambda: _AsyncBridgeProtocol(self), self._port)
+        self._writer, _ = await loop.connect_write_pipe(
+            asyncio.Protocol,
+            os.fdopen(os.dup(self._port.fileno()), 'wb', buffering=0))
+
+    async def close(self):
+        self._writer.close()
+        self._reader.close()
+
+    def write_raw(self, data):
+        self._writer.write(data)
+
+class _AsyncProcessProtocol(asyncio.SubprocessProtocol):
+    def __init__(self, bridge):
+        self._bridge = bridge
+        self.exited = asyncio.get_running_loop().create_future()
+
+    def pipe_data_received(self, fd, data):
+        if fd == 1:
+            self._bridge._data_received(data)
+
+    def process_exited(self):
+        self._bridge._connection_lost(None)
+        self.exited.set_result(None)
+
+class AsyncProcessBridge(AsyncBridge):
+    def __init__(self, args, **kwargs):
+        self._args = args
+        super().__init__(**kwargs)
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        self._proc, self._protocol = await loop.subprocess_exec(
+            lambda: _AsyncProcessProtocol(self), *self._args,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._stdin = self._proc.get_pipe_transport(0)
+
+    async def close(self):
+        self._proc.terminate()
+        await self._protocol.exited
+        self._proc.close()
+
+    def write_raw(self, data):
+        self._stdin.write(data)
+
 def hexdump(data, start=0, linesize=16, file=None, end=True):
     for i in range(0, len(data), linesize):
         chunk = data[i:i + linesize]
@@ -444,24 +2105,45 @@ def hexdump(data, start=0, linesize=16, file=None, end=True):
     if end:
         print(f'{start + len(data):08x}', file=file)
 
+def _is_regular_file(f):
+    try:
+        return stat.S_ISREG(os.fstat(f.fileno()).st_mode)
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        return False
+
 @click.group()
 @click.argument('path')
 @click.option('--sim', is_flag=True)
 @click.option('--cycles', type=alegria.cli.BasedInt(), default=None)
 @click.option('--vcd', default=None)
 @click.option('-b', '--baud', type=int, default=1_000_000, show_default=True)
+@click.option('-w', '--window', type=click.IntRange(1, 2), default=2,
+              show_default=True)
+@click.option('-t', '--timeout', type=float, default=None)
+@click.option('--checked', is_flag=True)
+@click.option('--retries', type=int, default=3, show_default=True)
 @click.option('-d', '--debug', is_flag=True)
 @click.pass_context
-def cli(ctx, path, sim, cycles, vcd, baud, debug):
+def cli(ctx, path, sim, cycles, vcd, baud, window, timeout, checked, retries,
+        debug):
+    modes = None
+    if checked:
+        modes = _BridgeBase._default_modes | _BridgeBase.Mode.CHECKED
+        # lost frames are only noticed by waiting on them
+        if timeout is None:
+            timeout = 1.0
+
+    kwargs = dict(debug=debug, window=window, timeout=timeout, modes=modes,
+                  retries=retries)
     if sim:
         args = [path]
         if cycles is not None:
             args += ['-c', str(cycles)]
         if vcd is not None:
             args += ['-v', vcd]
-        bridge = ProcessBridge(args, debug=debug)
+        bridge = ProcessBridge(args, **kwargs)
     else:
-        bridge = SerialBridge(path, baud=baud, debug=debug)
+        bridge = SerialBridge(path, baud=baud, **kwargs)
 
     ctx.obj = ctx.with_resource(bridge)
     bridge.ping()
@@ -481,7 +2163,7 @@ def reset(bridge, hold):
 @click.argument('end', type=alegria.cli.BasedInt(), required=False)
 @click.option('-n', '--length', type=alegria.cli.BasedInt(), default=None)
 @click.option('--hex', is_flag=True)
-@click.option('-o', '--output', type=click.File('wb'), default='-')
+@click.option('-o', '--output', type=click.File('w+b'), default='-')
 @pass_bridge
 def read(bridge, start, end, length, hex, output):
     if length is None:
@@ -491,6 +2173,13 @@ def read(bridge, start, end, length, hex, output):
     length = end - start
 
     hex = hex or output.isatty()
+    if not hex and length > 0 and _is_regular_file(output):
+        # read directly into the output file
+        output.truncate(length)
+        with mmap.mmap(output.fileno(), length) as view:
+            bridge.read_bytes_into(start, view)
+        return
+
     if hex:
         output = io.TextIOWrapper(output, encoding='ascii')
 
@@ -523,7 +2212,7 @@ def write(bridge, start, input, reset):
                 return
 
     try:
-        bridge.write_bytes_in_chunks(start, chunks())
+        bridge.write_bytes_in_chunks(start, chunks(), posted=True)
     finally:
         if reset:
             bridge.reset(False)
@@ -554,6 +2243,53 @@ def peek(bridge, start, end, length):
 def poke(bridge, start, words):
     bridge.write_words(start, words)
 
+@cli.command()
+@click.argument('start', type=alegria.cli.BasedInt())
+@click.argument('end', type=alegria.cli.BasedInt())
+@click.argument('pattern', type=alegria.cli.BasedInt())
+@click.option('-m', '--mask', type=alegria.cli.BasedInt(), default=None)
+@click.option('-a', '--all', 'all_', is_flag=True)
+@pass_bridge
+@click.pass_context
+def search(ctx, bridge, start, end, pattern, mask, all_):
+    found = False
+    addr = start
+    while addr < end:
+        addr = bridge.search(addr, end - addr, pattern, mask=mask)
+        if addr is None:
+            break
+        print(f'{addr:08x}: 0x{bridge.read_words(addr, 1)[0]:08x}')
+        found = True
+        if not all_:
+            break
+        addr += bridge.word_size
+
+    if not found:
+        ctx.exit(1)
+
+@cli.command()
+@click.argument('address', type=alegria.cli.BasedInt())
+@click.argument('pattern', type=alegria.cli.BasedInt())
+@click.option('-m', '--mask', type=alegria.cli.BasedInt(), default=None)
+@click.option('-c', '--cycles', type=alegria.cli.BasedInt(), default=None)
+@click.option('-n', '--not', 'invert', is_flag=True)
+@pass_bridge
+@click.pass_context
+def wait(ctx, bridge, address, pattern, mask, cycles, invert):
+    value = bridge.wait(address, pattern, mask=mask, cycles=cycles,
+                        invert=invert)
+    if value is None:
+        ctx.exit(1)
+    print(f'{address:08x}: 0x{value:08x}')
+
+@cli.command()
+@click.argument('start', type=alegria.cli.BasedInt())
+@click.argument('end', type=alegria.cli.BasedInt())
+@click.argument('word', type=alegria.cli.BasedInt(), required=False, default=0)
+@pass_bridge
+def fill(bridge, start, end, word):
+    bridge.fill(start, end - start, word)
+
 @cli.command()
 @click.argument('elf', type=click.File('rb'))
 @click.option('--rtt-address', type=alegria.cli.BasedInt(), default=None)
@@ -561,10 +2297,17 @@ def poke(bridge, start, words):
               default=0, show_default=True)
 @click.option('--rtt-end', type=alegria.cli.BasedInt(),
               default=1 << 32, show_default=True)
+@click.option('--rtt-symbol', default='_SEGGER_RTT', show_default=True)
+@click.option('--rtt-cache/--no-rtt-cache', default=True, show_default=True)
 @click.option('-a', '--attach', is_flag=True)
+@click.option('--verify', is_flag=True)
+@click.option('--delta', is_flag=True)
+@click.option('--block-size', type=alegria.cli.BasedInt(),
+              default=0x1000, show_default=True)
 @pass_bridge
 @click.pass_context
-def program(ctx, bridge, elf, rtt_address, rtt_start, rtt_end, attach):
+def program(ctx, bridge, elf, rtt_address, rtt_start, rtt_end, rtt_symbol,
+            rtt_cache, attach, verify, delta, block_size):
     elf = ELFFile(elf)
 
     bridge.reset(True)
@@ -578,12 +2321,75 @@ def program(ctx, bridge, elf, rtt_address, rtt_start, rtt_end, attach):
             start = seg['p_paddr']
 
             print(f'0x{start:08x} - 0x{start + len(data):08x} ...')
-            bridge.write_bytes(start, data)
+            if delta:
+                _program_delta(bridge, start, data, block_size)
+            else:
+                bridge.write_bytes(start, data, posted=True)
+
+            if verify:
+                _program_verify(bridge, start, data, block_size)
+
+            # the rest of the segment is zeroed, like .bss
+            zeros = seg['p_memsz'] - len(data)
+            if zeros > 0:
+                start += len(data)
+                print(f'0x{start:08x} - 0x{start + zeros:08x} (zero) ...')
+                _program_zero(bridge, start, zeros)
     finally:
         bridge.reset(False)
 
     if attach:
-        ctx.invoke(rtt, address=rtt_address, start=rtt_start, end=rtt_end)
+        ctx.invoke(rtt, address=rtt_address, start=rtt_start, end=rtt_end,
+                   elf=elf.stream, symbol=rtt_symbol, cache=rtt_cache)
+
+# split data at start into word-aligned blocks, as (address, block). any
+# partial words at either end are filled out with what is there already
+def _program_blocks(bridge, start, data, block_size):
+    address, size, offset = bridge._align_range(start, len(data))
+    padded = bytearray(size)
+    if offset:
+        padded[:bridge.word_size] = bridge.read_bytes(address, bridge.word_size)
+    if (offset + len(data)) % bridge.word_size:
+        end = size - bridge.word_size
+        padded[end:] = bridge.read_bytes(address + end, bridge.word_size)
+    padded[offset:offset + len(data)] = data
+
+    for i in range(0, size, block_size):
+        yield (address + i, padded[i:i + block_size])
+
+# zero size bytes at start, using FILL for the whole words
+def _program_zero(bridge, start, size):
+    end = start + size
+    first = -(-start // bridge.word_size) * bridge.word_size
+    last = max(first, end // bridge.word_size * bridge.word_size)
+    bridge.fill(first, last - first)
+
+    if first > start:
+        bridge.write_bytes(start, bytes(min(first, end) - start))
+    if end > last:
+        bridge.write_bytes(last, bytes(end - last))
+
+def _program_delta(bridge, start, data, block_size):
+    blocks = list(_program_blocks(bridge, start, data, block_size))
+    address, size, _ = bridge._align_range(start, len(data))
+    # finish all the crcs before writing anything
+    crcs = list(bridge.crc32_in_chunks(address, size, block_size))
+
+    changed = 0
+    for (addr, block), crc in zip(blocks, crcs):
+        if zlib.crc32(block) != crc:
+            bridge.write_bytes(addr, block, posted=True)
+            changed += 1
+    print(f'    {changed} of {len(blocks)} blocks changed')
+
+def _program_verify(bridge, start, data, block_size):
+    blocks = list(_program_blocks(bridge, start, data, block_size))
+    address, size, _ = bridge._align_range(start, len(data))
+    crcs = bridge.crc32_in_chunks(address, size, block_size)
+
+    for (addr, block), crc in zip(blocks, crcs):
+        if zlib.crc32(block) != crc:
+            raise RuntimeError(f'verify failed at 0x{addr:08x}')
 
 @cli.command()
 @click.option('--address', type=alegria.cli.BasedInt(), default=None)
@@ -591,9 +2397,16 @@ def program(ctx, bridge, elf, rtt_address, rtt_start, rtt_end, attach):
               default=0, show_default=True)
 @click.option('--end', type=alegria.cli.BasedInt(),
               default=1 << 32, show_default=True)
+@click.option('--elf', type=click.File('rb'), default=None)
+@click.option('--symbol', default='_SEGGER_RTT', show_default=True)
+@click.option('--cache/--no-cache', default=True, show_default=True)
+@click.option('--stats', is_flag=True)
 @pass_bridge
-def rtt(bridge, address, start, end):
-    rtt = bridge.find_rtt(address=address, start=start, end=end)
+def rtt(bridge, address, start, end, elf, symbol, cache, stats):
+    if elf is not None:
+        elf = ELFFile(elf)
+    rtt = bridge.find_rtt(address=address, start=start, end=end, elf=elf,
+                          symbol=symbol, cache=cache)
     up = None
     for up in rtt.iter_ups():
         if up.name == b'Terminal':
@@ -601,13 +2414,17 @@ def rtt(bridge, address, start, end):
     else:
         raise RuntimeError('could not find Terminal channel')
 
+    poller = rtt.poller
     while True:
-        data = up.read()
-        if data:
-            sys.stdout.buffer.write(data)
+        if up in rtt.poll():
+            sys.stdout.buffer.write(up.read(update=False))
             sys.stdout.buffer.flush()
-            continue
-        time.sleep(0.01)
+        rtt.wait()
+
+        if stats and poller.polls and poller.elapsed() >= 1:
+            print(f'rtt: {poller.poll_rate():.1f} polls/s, '
+                  f'{poller.byte_rate():.1f} bytes/s', file=sys.stderr)
+            poller.reset_stats()
 
 if __name__ == '__main__':
     cli()
@@ -0,0 +1,206 @@
+import binascii
+import zlib
+
+import amaranth as am
+import amaranth.lib.crc.catalog
+from parameterized import parameterized, parameterized_class
+
+from alegria.lib.crc_trailer import *
+from alegria.test import SimulatorTestCase
+
+# reference trailers, computed in python
+def crc16(data):
+    return binascii.crc_hqx(data, 0).to_bytes(2, 'big')
+
+def crc32(data):
+    return zlib.crc32(data).to_bytes(4, 'little')
+
+class CrcTrailerTestCase(SimulatorTestCase):
+    TEST_PARAMS = [
+        {'crc_name': name, 'tagged': tagged, 'write_delay': wd, 'read_delay': rd}
+        for name in ['CRC16_XMODEM', 'CRC32_ETHERNET']
+        for tagged in [False, True]
+        for wd in [0, 3]
+        for rd in [0, 3]
+    ]
+
+    @classmethod
+    def parameterized_class(cls, f):
+        def name(cls, num, params_dict):
+            return '_'.join([
+                cls.__name__,
+                str(num),
+                parameterized.to_safe_name(params_dict['crc_name']),
+                't' + parameterized.to_safe_name(params_dict['tagged']),
+                'wd' + parameterized.to_safe_name(params_dict['write_delay']),
+                'rd' + parameterized.to_safe_name(params_dict['read_delay']),
+            ])
+        return parameterized_class(cls.TEST_PARAMS, class_name_func=name)(f)
+
+    @property
+    def crc(self):
+        return getattr(am.lib.crc.catalog, self.crc_name)(data_width=8)
+
+    def trailer(self, frame, tag=None):
+        if self.tagged:
+            frame = frame + bytes([tag])
+        if self.crc_name == 'CRC16_XMODEM':
+            return frame + crc16(frame)
+        return frame + crc32(frame)
+
+    # returns (frame, frame word data) for each frame
+    async def frame_read(self, ctx, stream):
+        frame = []
+        in_frame = False
+        while True:
+            if self.read_delay:
+                await ctx.tick().repeat(self.read_delay)
+            v = await self.stream_get(ctx, stream)
+            if not in_frame and v.frame:
+                in_frame = True
+                continue
+            elif in_frame and v.frame:
+                return (bytes(frame), v.data)
+            else:
+                frame.append(v.data)
+
+    async def frame_write(self, ctx, stream, frame, end=0):
+        if self.write_delay:
+            await ctx.tick().repeat(self.write_delay)
+        await self.stream_put(ctx, stream, {'data': 0, 'frame': 1})
+
+        for v in frame:
+            if self.write_delay:
+                await ctx.tick().repeat(self.write_delay)
+            await self.stream_put(ctx, stream, {'data': v, 'frame': 0})
+
+        if self.write_delay:
+            await ctx.tick().repeat(self.write_delay)
+        await self.stream_put(ctx, stream, {'data': end, 'frame': 1})
+
+    # frames is a list of (frame written, frame read, frame word data read)
+    def run_checker_on(self, frames, enable=1):
+        dut = Checker(crc=self.crc, tagged=self.tagged)
+        with self.simulate(dut, traces=[dut.i_stream, dut.o_stream]) as sim:
+            sim.add_clock(am.Period(Hz=1_000_000))
+
+            @sim.add_testbench
+            async def write(ctx):
+                ctx.set(dut.enable, enable)
+                await ctx.tick().repeat(3)
+
+                for frame, _, _ in frames:
+                    sim.reset_deadline()
+                    await self.frame_write(ctx, dut.i_stream, frame)
+
+            @sim.add_testbench
+            async def read(ctx):
+                for _, frame, end in frames:
+                    sim.reset_deadline()
+                    value = await self.frame_read(ctx, dut.o_stream)
+                    self.assertEqual(value, (frame, end))
+
+    # frames is a list of (frame written, bad, frame read)
+    def run_appender_on(self, frames, enable=1):
+        dut = Appender(crc=self.crc, tagged=self.tagged)
+        with self.simulate(dut, traces=[dut.i_stream, dut.o_stream]) as sim:
+            sim.add_clock(am.Period(Hz=1_000_000))
+
+            @sim.add_testbench
+            async def write(ctx):
+                ctx.set(dut.enable, enable)
+                if self.tagged:
+                    ctx.set(dut.tag, 0x5a)
+                await ctx.tick().repeat(3)
+
+                for frame, bad, _ in frames:
+                    sim.reset_deadline()
+                    await self.frame_write(ctx, dut.i_stream, frame, end=bad)
+
+            @sim.add_testbench
+            async def read(ctx):
+                for _, _, frame in frames:
+                    sim.reset_deadline()
+                    value, _ = await self.frame_read(ctx, dut.o_stream)
+                    self.assertEqual(value, frame)
+
+@CrcTrailerTestCase.parameterized_class
+class TestCrcTrailer(CrcTrailerTestCase):
+    def test_checker(self):
+        self.run_checker_on([
+            (self.trailer(b'Hello', 1), b'Hello', 0),
+            (self.trailer(b'Wo\x00rld', 2), b'Wo\x00rld', 0),
+        ])
+
+    def test_checker_empty(self):
+        self.run_checker_on([
+            (self.trailer(b'', 1), b'', 0),
+        ])
+
+    def test_checker_bad(self):
+        bad = bytearray(self.trailer(b'Hello', 1))
+        bad[-1] ^= 0x10
+        self.run_checker_on([
+            (bytes(bad), b'Hello', 1),
+            (self.trailer(b'Hello', 1), b'Hello', 0),
+        ])
+
+    def test_checker_short(self):
+        self.run_checker_on([
+            (b'a', b'', 1),
+        ])
+
+    def test_checker_disabled(self):
+        self.run_checker_on([
+            (b'Hello', b'Hello', 0),
+            (b'a', b'a', 0),
+        ], enable=0)
+
+    def test_appender(self):
+        self.run_appender_on([
+            (b'Hello', 0, self.trailer(b'Hello', 0x5a)),
+            (b'Wo\x00rld', 0, self.trailer(b'Wo\x00rld', 0x5a)),
+        ])
+
+    def test_appender_bad(self):
+        good = self.trailer(b'Hello', 0x5a)
+        size = len(good) - len(b'Hello') - self.tagged
+        bad = good[:-size] + bytes(b ^ 0xff for b in good[-size:])
+        self.run_appender_on([
+            (b'Hello', 1, bad),
+            (b'Hello', 0, good),
+        ])
+
+    def test_appender_disabled(self):
+        self.run_appender_on([
+            (b'Hello', 0, b'Hello'),
+        ], enable=0)
+
+    def test_appender_checker(self):
+        dut = am.Module()
+        dut.submodules.appender = app = Appender(crc=self.crc, tagged=self.tagged)
+        dut.submodules.checker = chk = Checker(crc=self.crc, tagged=self.tagged)
+        am.lib.wiring.connect(dut, app.o_stream, chk.i_stream)
+
+        frames = [b'Hello', b'Wo\x00rld', b'a' * 300]
+        with self.simulate(dut, deadline=3000) as sim:
+            sim.add_clock(am.Period(Hz=1_000_000))
+
+            @sim.add_testbench
+            async def write(ctx):
+                ctx.set(app.enable, 1)
+                ctx.set(chk.enable, 1)
+                if self.tagged:
+                    ctx.set(app.tag, 0x5a)
+                await ctx.tick().repeat(3)
+
+                for frame in frames:
+                    sim.reset_deadline()
+                    await self.frame_write(ctx, app.i_stream, frame)
+
+            @sim.add_testbench
+            async def read(ctx):
+                for frame in frames:
+                    sim.reset_deadline()
+                    value = await self.frame_read(ctx, chk.o_stream)
+                    self.assertEqual(value, (frame, 0))
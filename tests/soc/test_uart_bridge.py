@@ -0,0 +1,1065 @@
+import asyncio
+import collections
+import contextlib
+import functools
+import io
+import json
+import os
+import random
+import struct
+import tempfile
+import time
+import unittest
+import zlib
+
+import amaranth as am
+import amaranth.back.rtlil
+
+import cobs.cobs
+from elftools.elf.elffile import ELFFile
+
+from alegria.soc import UartBridge
+from alegria.test import SimulatorTestCase
+from alegria.tools.bridge import AsyncBridge, Bridge
+from alegria.tools.bridge import _RttCache, _elf_digest, _elf_writable_ranges
+from alegria.tools.bridge import _program_blocks, _program_delta
+from alegria.tools.bridge import _program_verify
+
+# a host Bridge talking to a simulated UartBridge. it runs the simulator
+# whenever it waits on the bridge, so tests can use the host API directly
+class SimBridge(Bridge):
+    def __init__(self, sim, rx, tx, **kwargs):
+        self._sim = sim
+        # bytes on their way to the bridge, and bytes that came back
+        self._rx = rx
+        self._tx = tx
+        super().__init__(**kwargs)
+
+    def close(self):
+        pass
+
+    def read_raw(self, timeout=None):
+        # there is no wall clock in here, so timeout is ignored. the
+        # simulation deadline catches a bridge that never answers
+        while not self._tx:
+            self._sim.advance()
+        self._sim.reset_deadline()
+        data = bytes(self._tx)
+        self._tx.clear()
+        return data
+
+    def write_raw(self, data):
+        self._rx.extend(data)
+
+# the same, for AsyncBridge. the simulator runs in a task for as long as
+# any requests are waiting on responses
+class SimAsyncBridge(AsyncBridge):
+    def __init__(self, sim, rx, tx, **kwargs):
+        self._sim = sim
+        self._rx = rx
+        self._tx = tx
+        self._task = None
+        super().__init__(**kwargs)
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def write_raw(self, data):
+        self._rx.extend(data)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._simulate())
+
+    async def _simulate(self):
+        while self._pending:
+            self._sim.advance()
+            if self._tx:
+                self._sim.reset_deadline()
+                data = bytes(self._tx)
+                self._tx.clear()
+                self._data_received(data)
+            # let the requests waiting on those see them
+            await asyncio.sleep(0)
+
+# drops and damages whole frames on their way to and from a simulated
+# bridge, for CHECKED. requests only have their crc damaged, so the
+# bridge still does what they say. each frame is lost with probability
+# loss, or the next actions in damage ('pass', 'drop' or 'flip') say
+# what happens to the next ones
+class Lossy:
+    def __init__(self, *args, seed=0, **kwargs):
+        self._rng = random.Random(seed)
+        self._incoming = bytearray()
+        self.loss = 0.0
+        self.damage = collections.deque()
+        # how many frames were dropped or damaged
+        self.damaged = 0
+        super().__init__(*args, **kwargs)
+
+    def _damage(self, frame, request):
+        if self.damage:
+            action = self.damage.popleft()
+        elif self._rng.random() < self.loss:
+            action = self._rng.choice(['drop', 'flip'])
+        else:
+            return b'\0' + frame + b'\0'
+        if action == 'pass':
+            return b'\0' + frame + b'\0'
+        self.damaged += 1
+        if action == 'drop':
+            return b''
+        data = bytearray(cobs.cobs.decode(frame))
+        i = len(data) - 1 if request else self._rng.randrange(len(data))
+        data[i] ^= 1 << self._rng.randrange(8)
+        return b'\0' + cobs.cobs.encode(data) + b'\0'
+
+    def _lossy_write(self, data):
+        for frame in bytes(data).split(b'\0'):
+            if frame:
+                self._rx.extend(self._damage(frame, True))
+
+    # take what the bridge sent, and return the whole frames in it
+    def _lossy_read(self):
+        self._incoming += bytes(self._tx)
+        self._tx.clear()
+        *frames, self._incoming[:] = self._incoming.split(b'\0')
+        return b''.join(self._damage(frame, False)
+                        for frame in frames if frame)
+
+class LossySimBridge(Lossy, SimBridge):
+    def write_raw(self, data):
+        self._lossy_write(data)
+
+    # a lost response never arrives, so give up after a while without
+    # anything, and let the timeout run out
+    def read_raw(self, timeout=None):
+        for _ in range(2000):
+            self._sim.advance()
+            data = self._lossy_read()
+            if data:
+                break
+        self._sim.reset_deadline()
+        return data
+
+class LossySimAsyncBridge(Lossy, SimAsyncBridge):
+    def write_raw(self, data):
+        self._lossy_write(data)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._simulate())
+
+    async def _simulate(self):
+        while self._pending:
+            self._sim.advance()
+            self._sim.reset_deadline()
+            data = self._lossy_read()
+            if data:
+                self._data_received(data)
+            await asyncio.sleep(0)
+
+# a memory with a FIFO at word address fifo, which reads as 1, 2, 3...
+class FifoMemory(collections.defaultdict):
+    def __init__(self, fifo):
+        super().__init__(int)
+        self.fifo = fifo
+        self.popped = 0
+
+    def __getitem__(self, address):
+        if address == self.fifo:
+            self.popped += 1
+            return self.popped
+        return super().__getitem__(address)
+
+# an RTT control block at 0x100 with a Terminal up channel holding
+# "hello", wrapped around the end of its buffer at 0x300. once that has
+# been read, "ab" shows up after it a while later
+def rtt_memory():
+    memory = collections.defaultdict(int)
+    def put(address, data):
+        for i in range(0, len(data), 4):
+            memory[(address + i) // 4] = int.from_bytes(
+                data[i:i + 4].ljust(4, b'\0'), 'little')
+    put(0x100, b'SEGGER RTT\0\0\0\0\0\0')
+    # one up and one down channel, but the down one has no buffer
+    put(0x110, b''.join(
+        word.to_bytes(4, 'little')
+        for word in [1, 1, 0x200, 0x300, 16, 3, 14, 0, 0, 0, 0, 0, 0, 0]))
+    put(0x200, b'Terminal\0')
+    put(0x300, b'llo' + bytes(11) + b'he')
+
+    async def process(ctx, memory):
+        # wait for the read offset to move past "hello"
+        while memory[0x4a] != 3:
+            await ctx.tick()
+        await ctx.tick().repeat(5000)
+        memory[0xc0] |= ord('a') << 24
+        memory[0xc1] |= ord('b')
+        memory[0x49] = 5
+
+    return memory, process
+
+# a little 32-bit ELF, with a PT_LOAD segment for each (address, data,
+# memsz, flags) in segments, and an absolute symbol for each in symbols
+def make_elf(segments, symbols={}):
+    ehdr = struct.Struct('<16sHHIIIIIHHHHHH')
+    phdr = struct.Struct('<8I')
+    shdr = struct.Struct('<10I')
+    sym = struct.Struct('<IIIBBH')
+
+    strtab = bytearray(b'\0')
+    symtab = bytearray(sym.size)
+    for name, value in symbols.items():
+        symtab += sym.pack(len(strtab), value, 0, 0x11, 0, 0xfff1)
+        strtab += name.encode() + b'\0'
+    shstrtab = b'\0.symtab\0.strtab\0.shstrtab\0'
+
+    offset = ehdr.size + phdr.size * len(segments)
+    headers = b''
+    body = b''
+    for address, data, memsz, flags in segments:
+        headers += phdr.pack(1, offset + len(body), address, address,
+                             len(data), memsz, flags, 4)
+        body += data
+    sections = []
+    for name, kind, data, link, entsize in [
+            (1, 2, symtab, 2, sym.size),
+            (9, 3, strtab, 0, 0),
+            (17, 3, shstrtab, 0, 0)]:
+        sections.append((name, kind, offset + len(body), len(data),
+                         link, entsize))
+        body += data
+
+    shoff = offset + len(body)
+    tail = shdr.pack(*[0] * 10)
+    for name, kind, start, size, link, entsize in sections:
+        tail += shdr.pack(name, kind, 0, 0, start, size, link,
+                          1 if kind == 2 else 0, 1, entsize)
+    head = ehdr.pack(b'\x7fELF\x01\x01\x01' + bytes(9), 2, 0xf3, 1, 0,
+                     ehdr.size, shoff, 0, ehdr.size, phdr.size,
+                     len(segments), shdr.size, 4, 3)
+    return ELFFile(io.BytesIO(head + headers + body + tail))
+
+class UartBridgeTestCase(SimulatorTestCase):
+    # clock cycles per uart bit
+    divisor = 1
+
+    def make_bridge(self, **kwargs):
+        kwargs = dict(addr_width=30, data_width=32, granularity=8,
+                      divisor=self.divisor) | kwargs
+        return UartBridge(**kwargs)
+
+    # run body(host, memory) against a simulated bridge on a wishbone
+    # memory, with latency extra cycles before each ack. memory is a
+    # dict of words, by word address. process(ctx, memory), if given,
+    # runs alongside. with an AsyncBridge host, body is a coroutine
+    def run_bridge(self, body, latency=0, memory=None, bridge={},
+                   process=None, host=SimBridge, **kwargs):
+        dut = self.make_bridge(**bridge)
+        if memory is None:
+            memory = collections.defaultdict(int)
+        rx = collections.deque()
+        tx = collections.deque()
+
+        with self.simulate(dut, deadline=20_000) as sim:
+            sim.add_clock(am.Period(Hz=1_000_000))
+
+            async def uart_in(ctx):
+                ctx.set(dut.rx, 1)
+                while True:
+                    if not rx:
+                        await ctx.tick()
+                        continue
+                    byte = rx.popleft()
+                    bits = [0] + [(byte >> i) & 1 for i in range(8)] + [1]
+                    for bit in bits:
+                        ctx.set(dut.rx, bit)
+                        for _ in range(self.divisor):
+                            await ctx.tick()
+
+            async def uart_out(ctx):
+                while True:
+                    await ctx.tick()
+                    if ctx.get(dut.tx):
+                        continue
+                    # from the middle of the start bit, sample each bit
+                    for _ in range(self.divisor // 2):
+                        await ctx.tick()
+                    byte = 0
+                    for i in range(8):
+                        for _ in range(self.divisor):
+                            await ctx.tick()
+                        byte |= ctx.get(dut.tx) << i
+                    for _ in range(self.divisor):
+                        await ctx.tick()
+                    tx.append(byte)
+
+            async def wishbone(ctx):
+                bus = dut.bus
+                while True:
+                    await ctx.tick()
+                    if not (ctx.get(bus.cyc) and ctx.get(bus.stb)):
+                        continue
+                    for _ in range(latency):
+                        await ctx.tick()
+                    adr = ctx.get(bus.adr)
+                    if ctx.get(bus.we):
+                        sel = ctx.get(bus.sel)
+                        mask = sum(0xff << (8 * i)
+                                   for i in range(4) if sel & (1 << i))
+                        memory[adr] = ((memory[adr] & ~mask) |
+                                       (ctx.get(bus.dat_w) & mask))
+                    else:
+                        ctx.set(bus.dat_r, memory[adr])
+                    ctx.set(bus.ack, 1)
+                    await ctx.tick()
+                    ctx.set(bus.ack, 0)
+
+            for testbench in [uart_in, uart_out, wishbone]:
+                sim.add_testbench(testbench, background=True)
+            if process is not None:
+                async def extra(ctx):
+                    await process(ctx, memory)
+                sim.add_testbench(extra, background=True)
+
+            host = host(sim, rx, tx, **kwargs)
+            if isinstance(host, AsyncBridge):
+                async def run():
+                    await host.ping()
+                    await body(host, memory)
+                asyncio.run(run())
+            else:
+                host.ping()
+                body(host, memory)
+
+        return memory
+
+class TestUartBridge(UartBridgeTestCase):
+    def test_elaborate(self):
+        for features in [set(), {'cti', 'bte'}]:
+            with self.subTest(features=features):
+                am.back.rtlil.convert(self.make_bridge(features=features))
+
+    def test_ping(self):
+        def body(host, memory):
+            self.assertEqual(host.mode, host.modes & UartBridge._modes)
+        self.run_bridge(body)
+
+    def test_granularity(self):
+        # host masks are per byte, so wider lanes get no MASKED
+        unmasked = UartBridge._modes & ~UartBridge.Mode.MASKED
+        for granularity, modes in [(8, UartBridge._modes),
+                                   (16, unmasked), (32, unmasked)]:
+            with self.subTest(granularity=granularity):
+                def body(host, memory):
+                    self.assertEqual(host.mode, host.modes & modes)
+                self.run_bridge(body, bridge=dict(granularity=granularity))
+
+    def test_read(self):
+        memory = collections.defaultdict(
+            int, {0x40 + i: 0x04030201 + 0x04040404 * i for i in range(16)})
+        data = bytes(range(1, 65))
+        def body(host, memory):
+            self.assertEqual(host.read_words(0x100, 2),
+                             [0x04030201, 0x08070605])
+            self.assertEqual(list(host.read_words_array(0x100, 2)),
+                             [0x04030201, 0x08070605])
+            result = host.read_bytes(0x100, 64)
+            self.assertIs(type(result), bytes)
+            self.assertEqual(result, data)
+            buffer = bytearray(64)
+            host.read_bytes_into(0x100, memoryview(buffer)[8:])
+            self.assertEqual(buffer, bytes(8) + data[:56])
+            self.assertEqual(host.read_c_string(0x100, 64), data)
+        self.run_bridge(body, memory=memory)
+
+    def test_long(self):
+        # longer than one READ or WRITE without LONG
+        words = [0x00010001 * i for i in range(600)]
+        for modes in [Bridge.Mode(0), Bridge.Mode.LONG]:
+            with self.subTest(modes=modes):
+                def body(host, memory):
+                    self.assertEqual(host.mode, modes)
+                    host.write_words(0x400, words)
+                    self.assertEqual(host.read_words(0x400, 600), words)
+                memory = self.run_bridge(body, modes=modes)
+                self.assertEqual([memory[0x100 + i] for i in range(600)],
+                                 words)
+
+    def test_burst(self):
+        # the prefetch and store buffers, against slow and fast buses
+        words = [0x11111111 * (i % 16) for i in range(40)]
+        for features in [set(), {'cti', 'bte'}]:
+            for latency in [0, 1, 3]:
+                with self.subTest(features=features, latency=latency):
+                    def body(host, memory):
+                        host.write_words(0x100, words)
+                        self.assertEqual(host.read_words(0x100, 40), words)
+                        # one word, and reads that end just after a write
+                        self.assertEqual(host.read_words(0x104, 1), words[1:2])
+                        host.write_words(0x1a0, [5])
+                        self.assertEqual(host.read_words(0x19c, 3),
+                                         [words[39], 5, 0])
+                    self.run_bridge(body, latency=latency,
+                                    bridge=dict(features=features))
+
+    def test_masked_write(self):
+        for posted in [False, True]:
+            with self.subTest(posted=posted):
+                memory = collections.defaultdict(
+                    int, {0x40 + i: 0xffffffff for i in range(4)})
+                def body(host, memory):
+                    host.write_bytes(0x101, b'abcdefg', posted=posted)
+                    host.write_bytes_in_chunks(0x109, [b'h', b'', b'ij'],
+                                               posted=posted)
+                    host.write_bytes(0x10e, b'k', posted=posted)
+                self.run_bridge(body, memory=memory)
+                data = b''.join(memory[0x40 + i].to_bytes(4, 'little')
+                                for i in range(4))
+                self.assertEqual(data, b'\xffabcdefg\xffhij\xff\xffk\xff')
+
+        # without MASKED, only whole words
+        def body(host, memory):
+            with self.assertRaises(ValueError):
+                host.write_bytes(0x100, b'abc')
+            host.write_bytes(0x100, b'abcd')
+            self.assertEqual(host.read_bytes(0x100, 4), b'abcd')
+        self.run_bridge(body, modes=Bridge._default_modes & ~Bridge.Mode.MASKED)
+
+    def test_fixed(self):
+        for modes in [Bridge.Mode(0), Bridge._default_modes]:
+            with self.subTest(modes=modes):
+                def body(host, memory):
+                    self.assertEqual(host.read_words(0x200, 5, fixed=True),
+                                     [1, 2, 3, 4, 5])
+                    # nothing read ahead of what was asked for
+                    self.assertEqual(host.read_words(0x200, 300, fixed=True),
+                                     list(range(6, 306)))
+                    host.write_words(0x100, range(8))
+                    self.assertEqual(host.read_words(0x100, 8), list(range(8)))
+                self.run_bridge(body, memory=FifoMemory(0x80), modes=modes)
+
+    def test_stream(self):
+        for modes in [Bridge.Mode(0), Bridge._default_modes]:
+            with self.subTest(modes=modes):
+                def body(host, memory):
+                    host.write_words(0x100, range(20))
+                    stream = host.stream_words(0x100, size=4, fixed=False)
+                    self.assertEqual([next(stream) for _ in range(10)],
+                                     list(range(10)))
+                    stream.close()
+
+                    stream = host.stream_words(0x200, size=3)
+                    self.assertEqual([next(stream) for _ in range(10)],
+                                     list(range(1, 11)))
+                    stream.close()
+                    # the bridge still works after a stream
+                    self.assertEqual(host.read_words(0x104, 2), [1, 2])
+                self.run_bridge(body, memory=FifoMemory(0x80), modes=modes)
+
+    def test_compact(self):
+        # lengths on either side of a second 7-bit length byte
+        words = [0x00010001 * i for i in range(200)]
+        for modes in [Bridge.Mode.COMPACT,
+                      Bridge.Mode.COMPACT | Bridge.Mode.LONG,
+                      Bridge._default_modes | Bridge.Mode.CHECKED]:
+            with self.subTest(modes=modes):
+                def body(host, memory):
+                    self.assertEqual(host.mode, modes)
+                    host.write_words(0x400, words)
+                    for amount in [1, 128, 129, 200]:
+                        self.assertEqual(host.read_words(0x400, amount),
+                                         words[:amount])
+                    with host.batch() as batch:
+                        batch.write_words(0x1000, words[:129])
+                        first = batch.read_words(0x400, 2)
+                        second = batch.read_words(0x1000, 129)
+                    self.assertEqual(first.result(), words[:2])
+                    self.assertEqual(second.result(), words[:129])
+                self.run_bridge(body, modes=modes)
+
+    def test_posted_write(self):
+        # without POST, posted writes get answers like any other
+        for modes in [Bridge._default_modes,
+                      Bridge._default_modes & ~Bridge.Mode.POST]:
+            with self.subTest(modes=modes):
+                def body(host, memory):
+                    host.write_bytes(0x100, b'hello, world', posted=True)
+                    host.write_bytes_in_chunks(
+                        0x200, [bytes(range(i, i + 100)) for i in range(3)],
+                        posted=True)
+                    self.assertEqual(host.read_bytes(0x100, 12),
+                                     b'hello, world')
+                memory = self.run_bridge(body, modes=modes)
+                self.assertEqual(memory[0x40],
+                                 int.from_bytes(b'hell', 'little'))
+                # 296 bytes in, in the third chunk
+                self.assertEqual(memory[0xca],
+                                 int.from_bytes(bytes(range(98, 102)),
+                                                'little'))
+
+    def test_batch(self):
+        for modes in [Bridge.Mode(0), Bridge._default_modes,
+                      Bridge._default_modes | Bridge.Mode.CHECKED]:
+            with self.subTest(modes=modes):
+                def body(host, memory):
+                    with host.batch() as batch:
+                        reset = batch.reset(True)
+                        batch.write_words(0x100, [1, 2, 3])
+                        ping = batch.ping()
+                        first = batch.read_words(0x104, 2)
+                        # more than one READ can carry
+                        batch.write_words(0x200, range(300))
+                        second = batch.read_words(0x200, 300)
+                        batch.reset(False)
+                        with self.assertRaises(RuntimeError):
+                            first.result()
+                    self.assertEqual(reset.result(), None)
+                    self.assertEqual(ping.result(), [])
+                    self.assertEqual(first.result(), [2, 3])
+                    self.assertEqual(second.result(), list(range(300)))
+                    # the mode is the same after PING in a batch
+                    self.assertEqual(host.read_words(0x100, 1), [1])
+                self.run_bridge(body, modes=modes)
+
+    def test_batch_window(self):
+        # many short reads in flight at once must not overflow the rx fifo
+        memory = collections.defaultdict(int, {i: 3 * i for i in range(40)})
+        for modes in [Bridge.Mode(0), Bridge._default_modes,
+                      Bridge._default_modes | Bridge.Mode.CHECKED]:
+            with self.subTest(modes=modes):
+                def body(host, memory):
+                    with host.batch() as batch:
+                        results = [batch.read_words(4 * i, 1)
+                                   for i in range(40)]
+                    self.assertEqual([r.result() for r in results],
+                                     [[3 * i] for i in range(40)])
+                self.run_bridge(body, memory=memory, window=2, modes=modes)
+
+    def test_crc32(self):
+        memory = collections.defaultdict(
+            int, {0x40 + i: 0x01010101 * i for i in range(24)})
+        data = b''.join((0x01010101 * i).to_bytes(4, 'little')
+                        for i in range(24))
+        # without BLOCK, the host reads it all and checks it instead
+        for modes in [Bridge._default_modes,
+                      Bridge._default_modes & ~Bridge.Mode.BLOCK]:
+            with self.subTest(modes=modes):
+                def body(host, memory):
+                    self.assertEqual(host.crc32(0x100, 96), zlib.crc32(data))
+                    self.assertEqual(host.crc32(0x100, 0), zlib.crc32(b''))
+                    self.assertEqual(
+                        list(host.crc32_in_chunks(0x100, 88, 16)),
+                        [zlib.crc32(data[i:min(i + 16, 88)])
+                         for i in range(0, 88, 16)])
+                self.run_bridge(body, memory=memory, modes=modes)
+
+    def test_fill(self):
+        # without BLOCK, the host sends every word instead
+        for modes in [Bridge._default_modes,
+                      Bridge._default_modes & ~Bridge.Mode.BLOCK]:
+            with self.subTest(modes=modes):
+                def body(host, memory):
+                    host.fill(0x104, 0x1f8, 0xdeadbeef)
+                    host.fill(0x400, 0)
+                memory = self.run_bridge(body, modes=modes)
+                self.assertEqual(dict(memory),
+                                 {i: 0xdeadbeef for i in range(0x41, 0xbf)})
+
+    def test_program(self):
+        # bytes 0x100 to 0x180 start out as 0, 1, 2..., and the segment
+        # starts and ends part way through a word, in 16 byte blocks
+        device = bytes(range(0x80))
+        start, end = 0x102, 0x13f
+        data = bytearray(device[start - 0x100:end - 0x100])
+        data[0x25 - 2] ^= 0xff
+
+        for modes in [Bridge._default_modes,
+                      Bridge._default_modes & ~Bridge.Mode.BLOCK]:
+            with self.subTest(modes=modes):
+                memory = collections.defaultdict(int)
+                for i in range(0, len(device), 4):
+                    memory[(0x100 + i) >> 2] = int.from_bytes(
+                        device[i:i + 4], 'little')
+
+                def body(host, memory):
+                    # the edge words are filled in from the device
+                    blocks = list(_program_blocks(host, start, data, 0x10))
+                    self.assertEqual([a for a, _ in blocks],
+                                     [0x100, 0x110, 0x120, 0x130])
+                    self.assertEqual(b''.join(b for _, b in blocks),
+                                     device[:2] + data + device[0x3f:0x40])
+
+                    # only the changed block is written
+                    writes = []
+                    write_bytes = host.write_bytes
+                    def spy(address, data, **kwargs):
+                        writes.append((address, len(data)))
+                        return write_bytes(address, data, **kwargs)
+                    host.write_bytes = spy
+                    out = io.StringIO()
+                    with contextlib.redirect_stdout(out):
+                        _program_delta(host, start, data, 0x10)
+                    self.assertEqual(writes, [(0x120, 0x10)])
+                    self.assertEqual(out.getvalue().strip(),
+                                     '1 of 4 blocks changed')
+
+                    _program_verify(host, start, data, 0x10)
+                    host.write_bytes(0x13e, b'!')
+                    with self.assertRaisesRegex(RuntimeError,
+                                                'verify failed at 0x00000130'):
+                        _program_verify(host, start, data, 0x10)
+
+                memory = self.run_bridge(body, memory=memory, modes=modes)
+                written = b''.join(memory[i].to_bytes(4, 'little')
+                                   for i in range(0x40, 0x60))
+                expected = bytearray(device)
+                expected[2:0x3f] = data
+                expected[0x3e] = ord('!')
+                self.assertEqual(written, bytes(expected))
+
+    def test_rtt_elf(self):
+        memory, _ = rtt_memory()
+        code = (0x1000, b'code', 4, 5)
+        writable = (0, b'', 0x400, 6)
+        with tempfile.TemporaryDirectory() as tmp:
+            def body(host, memory):
+                host._rtt_timeout = 0.01
+                cache = _RttCache(os.path.join(tmp, 'rtt.json'))
+                def find(elf):
+                    rtt = host.find_rtt(elf=elf, cache=cache)
+                    return rtt._address
+
+                # at the symbol, which is then cached
+                elf = make_elf([code, writable], {'_SEGGER_RTT': 0x100})
+                self.assertEqual(find(elf), 0x100)
+                self.assertEqual(cache.get(_elf_digest(elf)), 0x100)
+
+                # the symbol is from some other build, or missing, so the
+                # writable segments are searched
+                for symbols in [{'_SEGGER_RTT': 0x180}, {}]:
+                    with self.subTest(symbols=symbols):
+                        elf = make_elf([code, writable], symbols)
+                        self.assertEqual(find(elf), 0x100)
+
+                # a stale cache entry is passed over, and replaced
+                elf = make_elf([code, writable], {'_SEGGER_RTT': 0x100,
+                                                  'main': 0x1000})
+                cache.set(_elf_digest(elf), 0x180)
+                self.assertEqual(find(elf), 0x100)
+                self.assertEqual(cache.get(_elf_digest(elf)), 0x100)
+
+                # a good one is used, even when nothing else would find it
+                elf = make_elf([code])
+                cache.set(_elf_digest(elf), 0x100)
+                self.assertEqual(find(elf), 0x100)
+
+                # and without that, there is nowhere else to look
+                elf = make_elf([code, (0x200, b'', 0x100, 6)])
+                with self.assertRaises(RuntimeError):
+                    find(elf)
+            self.run_bridge(body, memory=memory)
+
+    def test_block_pieces(self):
+        # with a timeout, these are split into pieces that start small
+        # and grow, and CRC puts the pieces' crcs back together
+        memory = collections.defaultdict(
+            int, {0x40 + i: 0x00010001 * i for i in range(200)})
+        data = b''.join((0x00010001 * i).to_bytes(4, 'little')
+                        for i in range(200))
+        def body(host, memory):
+            host._block_words_min = 4
+            self.assertEqual(host.crc32(0x100, 800), zlib.crc32(data))
+            self.assertEqual(host.search(0x100, 800, 150, mask=0xffff),
+                             0x100 + 600)
+            self.assertEqual(host.search(0x100, 800, 1234), None)
+            host.fill(0x104, 0x3f8, 0xdeadbeef)
+        memory = self.run_bridge(body, memory=memory, timeout=60.0)
+        self.assertEqual(memory[0x40], 0)
+        self.assertEqual(memory[0x41], 0xdeadbeef)
+        self.assertEqual(memory[0x13e], 0xdeadbeef)
+        self.assertEqual(memory[0x13f], 0)
+
+    # with CHECKED, damaged and lost frames are sent again, with several
+    # in flight, in batches, and after leaving responses behind
+    def test_lossy(self):
+        memory = collections.defaultdict(
+            int, {0x40 + i: 0x00010001 * i for i in range(64)})
+        expected = [0x00010001 * i for i in range(64)]
+        modes = Bridge._default_modes | Bridge.Mode.CHECKED
+        for seed in range(3):
+            with self.subTest(seed=seed):
+                def body(host, memory):
+                    # many small READs, to have several in flight
+                    host._read_size = 4
+                    host.loss = 0.1
+                    for _ in range(3):
+                        self.assertEqual(host.read_words(0x100, 64), expected)
+                    for chunk in host.read_words_in_chunks(0x100, 64):
+                        break
+                    with host.batch() as batch:
+                        results = [batch.read_words(0x100 + 16 * i, 4)
+                                   for i in range(16)]
+                    self.assertEqual(sum((r.result() for r in results), []),
+                                     expected)
+                    self.assertTrue(host.damaged)
+                self.run_bridge(body, memory=memory, modes=modes, window=4,
+                                retries=20, timeout=0.2,
+                                host=functools.partial(LossySimBridge,
+                                                       seed=seed))
+
+    # writes are not sent again, since they may have written memory
+    def test_lossy_write(self):
+        def body(host, memory):
+            # the request made it, but its response did not
+            host.damage.extend(['pass', 'drop'])
+            with self.assertRaises(RuntimeError):
+                host.write_words(0x100, [1])
+            # the request was damaged, but the bridge wrote it anyway
+            host.damage.append('flip')
+            with self.assertRaises(RuntimeError):
+                host.write_words(0x104, [2])
+            self.assertEqual([memory[0x40], memory[0x41]], [1, 2])
+            # reads are sent again
+            host.damage.extend(['pass', 'drop', 'flip'])
+            self.assertEqual(host.read_words(0x100, 2), [1, 2])
+        modes = Bridge._default_modes | Bridge.Mode.CHECKED
+        self.run_bridge(body, modes=modes, timeout=0.2, host=LossySimBridge)
+
+    def test_copy(self):
+        # without BLOCK, the host reads it all and writes it back instead
+        for modes in [Bridge._default_modes,
+                      Bridge._default_modes & ~Bridge.Mode.BLOCK]:
+            with self.subTest(modes=modes):
+                memory = collections.defaultdict(
+                    int, {0x40 + i: i + 1 for i in range(16)})
+                def body(host, memory):
+                    host.copy(0x100, 0x200, 0x40)
+                    # overlapping, both ways
+                    host.copy(0x100, 0x110, 0x40)
+                    host.copy(0x204, 0x200, 0x3c)
+                self.run_bridge(body, memory=memory, modes=modes)
+                self.assertEqual([memory[0x40 + i] for i in range(20)],
+                                 [1, 2, 3, 4] + list(range(1, 17)))
+                self.assertEqual([memory[0x80 + i] for i in range(16)],
+                                 list(range(2, 17)) + [16])
+
+    def test_wait(self):
+        async def process(ctx, memory):
+            # change the word being waited on, a while in
+            await ctx.tick().repeat(5000)
+            memory[0x40] = 0x5678
+
+        # without WAIT, the host polls instead
+        for modes in [Bridge._default_modes,
+                      Bridge._default_modes & ~Bridge.Mode.WAIT]:
+            with self.subTest(modes=modes):
+                memory = collections.defaultdict(int, {0x40: 0x1234})
+                def body(host, memory):
+                    self.assertEqual(host.wait(0x100, 0x1234), 0x1234)
+                    self.assertEqual(host.wait(0x100, 0x34, mask=0xff),
+                                     0x1234)
+                    self.assertEqual(host.wait(0x100, 0, invert=True),
+                                     0x1234)
+                    self.assertEqual(host.wait(0x100, 0, cycles=100), None)
+                    self.assertEqual(
+                        host.wait(0x100, 0x1234, invert=True, cycles=100),
+                        None)
+                    self.assertEqual(host.wait(0x100, 0x5678), 0x5678)
+                self.run_bridge(body, memory=memory, modes=modes,
+                                process=process)
+
+    def test_search(self):
+        memory = collections.defaultdict(int, {0x10: 0x1234, 0x18: 0x5678})
+        # a lone first word of the RTT magic, then the whole thing
+        magic = b'SEGGER RTT\0\0\0\0\0\0'
+        memory[0x20] = int.from_bytes(magic[:4], 'little')
+        for i in range(4):
+            memory[0x41 + i] = int.from_bytes(magic[4 * i:4 * i + 4], 'little')
+
+        # without BLOCK, the host looks through it all instead
+        for modes in [Bridge._default_modes,
+                      Bridge._default_modes & ~Bridge.Mode.BLOCK]:
+            with self.subTest(modes=modes):
+                def body(host, memory):
+                    self.assertEqual(host.search(0, 0x100, 0x1234), 0x40)
+                    self.assertEqual(host.search(0, 0x40, 0x1234), None)
+                    self.assertEqual(
+                        host.search(0x44, 0xbc, 0x78, mask=0xff), 0x60)
+                    rtt = host.find_rtt(start=0, end=0x200, cache=False)
+                    self.assertEqual(rtt._address, 0x104)
+                self.run_bridge(body, memory=memory, modes=modes)
+
+    def test_rtt(self):
+        memory, process = rtt_memory()
+        def body(host, memory):
+            rtt = host.find_rtt(start=0, end=0x400, cache=False)
+            up = rtt.get_up(0)
+            self.assertEqual(up.name, b'Terminal')
+            self.assertEqual(list(rtt.iter_ups()), [up])
+            with self.assertRaises(RuntimeError):
+                rtt.get_down(0)
+
+            # these read everything in, like find_rtt
+            self.assertEqual(
+                host.RttControl(host, 0x100).get_up(0).name, b'Terminal')
+            self.assertEqual(host.RttChannel(host, 0x118).name, b'Terminal')
+
+            self.assertEqual(rtt.poll(), [up])
+            self.assertEqual(up.read(update=False), b'hello')
+            self.assertEqual(memory[0x4a], 3)
+            self.assertEqual(up.get_data(), 0)
+            self.assertEqual(up.read(), b'')
+            # with an amount, this waits for all of it
+            self.assertEqual(up.read(2), b'ab')
+            self.assertEqual(up.getchar(wait=False), None)
+        self.run_bridge(body, memory=memory, process=process)
+
+class TestAsyncBridge(UartBridgeTestCase):
+    def run_bridge(self, body, host=SimAsyncBridge, **kwargs):
+        return super().run_bridge(body, host=host, **kwargs)
+
+    def test_ping(self):
+        async def body(host, memory):
+            self.assertEqual(host.mode, host.modes & UartBridge._modes)
+        self.run_bridge(body)
+
+    def test_read_write(self):
+        async def body(host, memory):
+            await host.write_words(0x100, list(range(100)))
+            self.assertEqual(await host.read_words(0x100, 100),
+                             list(range(100)))
+            await host.write_bytes(0x105, b'ab')
+            self.assertEqual(await host.read_bytes(0x104, 4), b'\x01ab\x00')
+        self.run_bridge(body, window=3)
+
+    def test_block(self):
+        # without BLOCK, the host does these itself
+        for modes in [Bridge._default_modes,
+                      Bridge._default_modes & ~Bridge.Mode.BLOCK]:
+            with self.subTest(modes=modes):
+                async def body(host, memory):
+                    await host.fill(0x100, 0x40, 0x1234)
+                    await host.copy(0x100, 0x120, 0x40)
+                    self.assertEqual(await host.read_words(0x100, 0x18),
+                                     [0x1234] * 0x18)
+                    self.assertEqual(await host.search(0, 0x200, 0x1234),
+                                     0x100)
+                    self.assertEqual(await host.search(0, 0x100, 0x1234),
+                                     None)
+                    self.assertEqual(await host.wait(0x100, 0x1234), 0x1234)
+                self.run_bridge(body, modes=modes)
+
+    def test_rtt(self):
+        memory, process = rtt_memory()
+        async def body(host, memory):
+            rtt = await host.find_rtt(start=0, end=0x400, cache=False)
+            up = rtt.get_up(0)
+            self.assertEqual(up.name, b'Terminal')
+            self.assertEqual(await rtt.poll(), [up])
+            self.assertEqual(await up.read(update=False), b'hello')
+            self.assertEqual(memory[0x4a], 3)
+            self.assertEqual(await up.read(2, wait=True), b'ab')
+            self.assertEqual(await up.getchar(wait=False), None)
+        self.run_bridge(body, memory=memory, process=process)
+
+    # like TestUartBridge.test_lossy, for _frame_received
+    def test_lossy(self):
+        memory = collections.defaultdict(
+            int, {0x40 + i: 0x00010001 * i for i in range(64)})
+        expected = [0x00010001 * i for i in range(64)]
+        modes = Bridge._default_modes | Bridge.Mode.CHECKED
+        for seed in range(3):
+            with self.subTest(seed=seed):
+                async def body(host, memory):
+                    host._read_size = 4
+                    host.loss = 0.1
+                    for _ in range(3):
+                        self.assertEqual(await host.read_words(0x100, 64),
+                                         expected)
+                    async with host.batch() as batch:
+                        results = [batch.read_words(0x100 + 16 * i, 4)
+                                   for i in range(16)]
+                    self.assertEqual(sum((r.result() for r in results), []),
+                                     expected)
+                    self.assertTrue(host.damaged)
+
+                    host.damage.extend(['pass', 'drop'])
+                    with self.assertRaises(RuntimeError):
+                        await host.write_words(0x200, [1])
+                self.run_bridge(body, memory=memory, modes=modes, window=4,
+                                retries=20, timeout=0.2,
+                                host=functools.partial(LossySimAsyncBridge,
+                                                       seed=seed))
+
+class TestBridgePing(unittest.TestCase):
+    def test_ping_responses(self):
+        host = Bridge()
+        for frame, mode in [
+                # stops at the first PING
+                (b'\x00', Bridge.Mode(0)),
+                # no CONFIG
+                (b'\x00\x00\x01', Bridge.Mode(0)),
+                (b'\x00\x00\x07\x03', Bridge.Mode(0x03)),
+        ]:
+            with self.subTest(frame=frame):
+                host._unpack_ping(frame)
+                self.assertEqual(host.mode, mode)
+
+        for frame in [b'', b'\x01', b'\x00\x03']:
+            with self.subTest(frame=frame):
+                with self.assertRaises(RuntimeError):
+                    host._unpack_ping(frame)
+
+class TestBridgeBatch(unittest.TestCase):
+    def frames(self, ping):
+        host = Bridge()
+        host._unpack_ping(ping)
+        batch = host.Batch(host)
+        batch.ping()
+        batch.read_words(0x100, 2)
+        batch.write_words(0x200, [1, 2])
+        return [frame for frame, _, _ in batch._frames()]
+
+    def test_frames(self):
+        C = Bridge.Command
+        # bridges from before multi-command frames get one call a frame,
+        # and plain WRITEs
+        self.assertEqual(self.frames(b'\x00'), [
+            bytes([C.PING.value]),
+            bytes([C.READ.value]) + (0x100).to_bytes(4, 'little') + b'\x01',
+            bytes([C.WRITE.value]) + (0x200).to_bytes(4, 'little') +
+            b'\x01\0\0\0\x02\0\0\0',
+        ])
+        # ones with multi-command frames get it all in one, CONFIG or not
+        self.assertEqual(len(self.frames(b'\x00\x00\x01')), 1)
+        self.assertEqual(len(self.frames(b'\x00\x00\x07\x03')), 1)
+
+class TestBridgeResend(unittest.TestCase):
+    def test_resendable(self):
+        host = Bridge()
+        C, M = Bridge.Command, Bridge.Modifier
+        for command, resendable in [
+                (C.READ, True), (C.CRC, True), (C.SEARCH, True),
+                (C.WAIT, True), (C.RESET, True),
+                # these pop FIFOs
+                (C.READ.value | M.FIXED.value, False), (C.STREAM, False),
+                # and these write to the bus
+                (C.WRITE, False), (C.WRITE.value | M.COUNTED.value, False),
+                (C.POST, False), (C.FILL, False), (C.COPY, False),
+        ]:
+            with self.subTest(command=command):
+                self.assertEqual(host._resendable(command), resendable)
+
+class TestRttElf(unittest.TestCase):
+    def test_writable_ranges(self):
+        # code, data with .bss after it, and an empty segment
+        elf = make_elf([(0x1000, b'code', 4, 5), (0x2000, b'data', 0x10, 6),
+                        (0x3000, b'', 0, 6)])
+        self.assertEqual(list(_elf_writable_ranges(elf)), [(0x2000, 0x2010)])
+
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'alegria', 'rtt.json')
+            cache = _RttCache(path)
+            self.assertEqual(cache.get('a'), None)
+            cache.set('a', 0x100)
+            self.assertEqual(_RttCache(path).get('a'), 0x100)
+
+            # the least recently set go first
+            cache.max_entries = 2
+            cache.set('b', 0x200)
+            cache.set('a', 0x100)
+            cache.set('c', 0x300)
+            self.assertEqual([cache.get(k) for k in 'abc'],
+                             [0x100, None, 0x300])
+
+            # anything wrong with the file is ignored
+            for junk in ['junk', '[]', json.dumps({'a': 'junk'})]:
+                with self.subTest(junk=junk):
+                    with open(path, 'w') as f:
+                        f.write(junk)
+                    self.assertEqual(cache.get('a'), None)
+                    cache.set('a', 0x100)
+
+            # and so is a path that can not be written
+            cache = _RttCache(os.path.join(path, 'rtt.json'))
+            cache.set('a', 0x100)
+            self.assertEqual(cache.get('a'), None)
+
+class TestBridgeWait(unittest.TestCase):
+    def test_wait_budget(self):
+        host = Bridge()
+        self.assertEqual(host._wait_budget(), host._wait_cycles)
+
+        # with a timeout, start small and aim for a quarter of it
+        host = Bridge(timeout=1.0)
+        first = host._wait_budget()
+        self.assertEqual(first, host._wait_cycles_min)
+        self.assertEqual(host._wait_budget(first, 0.01), 2 * first)
+        self.assertEqual(host._wait_budget(4 * first, 0.5), 2 * first)
+        self.assertEqual(host._wait_budget(first, 10.0), first)
+        self.assertEqual(host._wait_budget(host._wait_cycles, 0.0),
+                         host._wait_cycles)
+
+    def test_block_budget(self):
+        host = Bridge()
+        self.assertEqual(host._block_budget(), host._block_words)
+        host = Bridge(timeout=1.0)
+        first = host._block_budget()
+        self.assertEqual(first, host._block_words_min)
+        self.assertEqual(host._block_budget(first, 0.01), 2 * first)
+        self.assertEqual(host._block_budget(first, 10.0), first)
+
+# a bridge whose responses arrive a little at a time, delay seconds apart
+class SlowBridge(Bridge):
+    def __init__(self, chunks, delay, **kwargs):
+        self._chunks = collections.deque(chunks)
+        self._delay = delay
+        super().__init__(**kwargs)
+
+    def read_raw(self, timeout=None):
+        if not self._chunks:
+            time.sleep(timeout)
+            return b''
+        time.sleep(self._delay)
+        return self._chunks.popleft()
+
+class SlowAsyncBridge(AsyncBridge):
+    def __init__(self, chunks, delay, **kwargs):
+        self._chunks = chunks
+        self._delay = delay
+        super().__init__(**kwargs)
+
+    def write_raw(self, data):
+        async def respond():
+            for chunk in self._chunks:
+                await asyncio.sleep(self._delay)
+                self._data_received(chunk)
+        asyncio.ensure_future(respond())
+
+class TestBridgeTimeout(unittest.TestCase):
+    # the timeout only runs out when nothing arrives for that long, so a
+    # response slower than that as a whole still comes through
+    def chunks(self, frame):
+        data = Bridge()._encode_frame(frame)
+        return [data[i:i + 100] for i in range(0, len(data), 100)]
+
+    def test_slow_response(self):
+        frame = bytes(range(1, 256)) * 4
+        host = SlowBridge(self.chunks(frame), 0.02, timeout=0.1)
+        self.assertEqual(host.read_frame(), frame)
+
+        host = SlowBridge(self.chunks(frame)[:-1], 0.02, timeout=0.1)
+        with self.assertRaises(TimeoutError):
+            host.read_frame()
+
+    def test_slow_response_async(self):
+        frame = bytes(range(1, 256)) * 4
+        async def run(chunks):
+            host = SlowAsyncBridge(chunks, 0.02, timeout=0.1)
+            return await host._exchange(b'\x00')
+
+        self.assertEqual(asyncio.run(run(self.chunks(frame))), frame)
+        with self.assertRaises(TimeoutError):
+            asyncio.run(run(self.chunks(frame)[:-1]))